@@ -1,8 +1,13 @@
 from .fai import Fai
 from .tbx import Tbx
-from .bam import Bam
+from .bam import Bam, MultiBam
 from .vcf import VCF
 from .fisher import fisher_exact_test
+from .threads import ThreadPool
+from .index import BamIndex, TbxIndex
+from . import parallel
+from . import cache
+from . import aio
 
 __version__ = "0.0.3"
 
@@ -14,7 +19,12 @@ def doctests():
                       ("fai", hts.fai),
                       ("fisher", hts.fisher),
                       ("vcf", hts.vcf),
-                      ("bam", hts.bam)):
+                      ("bam", hts.bam),
+                      ("threads", hts.threads),
+                      ("cache", hts.cache),
+                      ("aio", hts.aio),
+                      ("index", hts.index),
+                      ("parallel", hts.parallel)):
 
         mod = getattr(hts, name)
         print("%s: %r" % (name, doctest.testmod(m=mod,
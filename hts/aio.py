@@ -0,0 +1,192 @@
+"""
+Region queries for servers with many concurrent requests.
+
+An `AsyncBam` is shared by all request handlers and reads each query on one
+of a fixed pool of file handles. On python 3, queries are also asynchronous
+iterators (`async for aln in bam.query(region)`) that read each batch in the
+event loop's default executor so the loop is not blocked.
+"""
+from .htsffi import libhts, ffi, _raise_if_null, _cstr
+from .bam import BamHeader, Alignment, _bam1_pool
+from .index import BamIndex
+import threading
+
+try:
+    from queue import Queue
+except ImportError: # python 2
+    from Queue import Queue
+
+try:
+    import asyncio
+except ImportError: # python 2
+    asyncio = None
+
+
+class AsyncBam(object):
+
+    """
+    Serve region queries from a BAM file to many concurrent callers.
+
+    The index and header are loaded once and shared. Queries are read in
+    batches; each batch checks out one of `max_workers` htsFile handles and
+    returns it afterwards, so at most `max_workers` batches are decoded at a
+    time and no more than `max_workers` files are ever open, however many
+    threads or tasks make queries. cffi releases the GIL during the calls
+    into htslib so batches on different handles decompress in parallel.
+    Alignments own their records, so they stay valid while other queries
+    proceed.
+
+    Parameters
+    ----------
+
+    fname : str
+        path to an indexed BAM file.
+
+    max_workers : int
+        number of file handles, i.e. the number of batches read at once.
+
+    batch_size : int
+        alignments read per call into C.
+
+    index : BamIndex or True, optional
+        a shared index, or True for the process-wide cache (see `Bam`).
+
+    Examples
+    --------
+
+    >>> import os.path as op
+    >>> bam = AsyncBam("%s/test/small.bam" % op.dirname(__file__), max_workers=2)
+    >>> [a.pos for a in bam.query('chr2L:9000-11000')][:3]
+    [9329, 10212, 10255]
+    >>> len(bam.fetch('chr2L:9000-11000'))
+    10
+    >>> bam.close()
+
+    With asyncio (python 3), in a coroutine::
+
+        async for aln in bam.query('chr2L:9000-11000'):
+            ...
+    """
+
+    def __init__(self, fname, max_workers=4, batch_size=256, index=None):
+        self.fn, self.max_workers, self.batch_size = fname, max_workers, batch_size
+        self._handles = Queue()
+        self._all = []
+        try:
+            for _ in range(max_workers):
+                htf = libhts.hts_open(_cstr(fname), b"r")
+                _raise_if_null(htf, "AsyncBam: bad file %s" % fname)
+                self._all.append(htf)
+                self._handles.put(htf)
+            htf = self._all[0]
+            if not libhts.bam_can_skim(htf):
+                raise ValueError("AsyncBam: %s is not a BAM file" % fname)
+            h = libhts.sam_hdr_read(htf)
+            _raise_if_null(h, "AsyncBam: bad header in %s" % fname)
+            self.header = BamHeader(ffi.gc(h, libhts.bam_hdr_destroy))
+
+            if index is True:
+                index = BamIndex.cached(fname)
+            if index is not None:
+                # shared with other handles; kept alive by self._index.
+                self._index, self._idx = index, index._idx
+            else:
+                idx = libhts.sam_index_load(htf, _cstr(fname))
+                _raise_if_null(idx, "AsyncBam: %s has no index" % fname)
+                self._idx = ffi.gc(idx, libhts.hts_idx_destroy)
+        except Exception:
+            self.close()
+            raise
+
+    def _checkout(self):
+        """Take a free handle, waiting if all are in use."""
+        if not self._all:
+            raise ValueError("AsyncBam: %s is closed" % self.fn)
+        return self._handles.get()
+
+    def query(self, region):
+        """Query a region; the result is an iterator that any thread may
+        advance and, on python 3, an asynchronous iterator."""
+        return _Query(self, region)
+
+    __call__ = query
+
+    def fetch(self, region):
+        """Return the list of alignments in a region."""
+        return list(self.query(region))
+
+    def close(self):
+        """Close the file handles once all checked out batches finish."""
+        handles, self._all = self._all, []
+        for _ in handles:
+            libhts.hts_close(self._handles.get())
+
+    def __repr__(self):
+        return "%s('%s', max_workers=%d)" % (self.__class__.__name__, self.fn,
+                                             self.max_workers)
+
+
+class _Query(object):
+
+    """A region query of an AsyncBam; see `AsyncBam.query`."""
+
+    def __init__(self, abam, region):
+        self._abam, self.region = abam, region
+        itr = libhts.sam_itr_querys(abam._idx, abam.header._h, _cstr(region))
+        _raise_if_null(itr, "AsyncBam: bad region %s" % region)
+        self._itr = ffi.gc(itr, libhts.hts_itr_destroy)
+        self._buf, self._done = [], False
+        # batches of one query must not be read at the same time.
+        self._lock = threading.Lock()
+
+    def _read_batch(self):
+        """Read the next batch on a handle from the pool."""
+        with self._lock:
+            if self._done:
+                return []
+            abam = self._abam
+            bs = [_bam1_pool.get() for _ in range(abam.batch_size)]
+            htf = abam._checkout()
+            try:
+                n = libhts.bam_itr_read_batch(htf, abam.header._h, self._itr,
+                                              ffi.new("bam1_t *[]", bs), len(bs))
+            finally:
+                abam._handles.put(htf)
+            if n < 0:
+                raise Exception("AsyncBam: error reading %s" % self.region)
+            if n < len(bs):
+                self._done = True
+            h = abam.header._h
+            return [Alignment(b, h) for b in bs[:n]]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._buf:
+            self._buf = self._read_batch()
+            self._buf.reverse()
+        if not self._buf:
+            raise StopIteration()
+        return self._buf.pop()
+
+    next = __next__
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        """Return an awaitable of the next alignment. Buffered alignments are
+        returned at once; a new batch is read in the default executor."""
+        loop = asyncio.get_event_loop()
+        if self._buf:
+            fut = loop.create_future()
+            fut.set_result(self._buf.pop())
+            return fut
+        return loop.run_in_executor(None, self._next_async)
+
+    def _next_async(self):
+        try:
+            return self.__next__()
+        except StopIteration:
+            raise StopAsyncIteration()
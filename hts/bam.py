@@ -1,8 +1,23 @@
 from __future__ import print_function
 from .htsffi import libhts, ffi, _raise_if_null
-import atexit
+from .threads import set_threads
+from .cache import set_cache
+from .fai import Fai
+from .index import BamIndex
+import array
+import heapq
 import os.path as op
 import sys
+from collections import OrderedDict
+
+# field bits for Bam(..., cram_opts={"required_fields": SAM_FLAG | SAM_POS})
+SAM_QNAME, SAM_FLAG, SAM_RNAME, SAM_POS = (libhts.SAM_QNAME, libhts.SAM_FLAG,
+                                           libhts.SAM_RNAME, libhts.SAM_POS)
+SAM_MAPQ, SAM_CIGAR, SAM_RNEXT, SAM_PNEXT = (libhts.SAM_MAPQ, libhts.SAM_CIGAR,
+                                             libhts.SAM_RNEXT, libhts.SAM_PNEXT)
+SAM_TLEN, SAM_SEQ, SAM_QUAL, SAM_AUX = (libhts.SAM_TLEN, libhts.SAM_SEQ,
+                                        libhts.SAM_QUAL, libhts.SAM_AUX)
+SAM_RGAUX = libhts.SAM_RGAUX
 
 class BamHeader(object):
     def __init__(self, h):
@@ -13,6 +28,11 @@ class BamHeader(object):
         for i in range(self._h.n_targets):
             yield ffi.string(self._h.target_name[i])
 
+    @property
+    def lengths(self):
+        for i in range(self._h.n_targets):
+            yield self._h.target_len[i]
+
 class Cigar(object):
 
     """
@@ -40,6 +60,90 @@ class Cigar(object):
         """repr."""
         return "Cigar('%s')" % str(self)
 
+def _sort_key(tid, pos):
+    """Coordinate-sort order of a position; unplaced reads (tid -1) go last."""
+    return (tid if tid >= 0 else 1 << 31, pos)
+
+class _Bam1Pool(object):
+
+    """Recycles bam1_t records so buffering many alignments avoids malloc/free.
+
+    Records from `get` are garbage-collected cdata; when the last reference is
+    dropped the record goes back onto the free list (up to `max_free` records)
+    instead of being destroyed, and its data buffer is reused by the next
+    read or `bam_copy1` into it.
+    """
+
+    def __init__(self, max_free=4096):
+        self.max_free = max_free
+        self._free = []
+
+    def _release(self, b):
+        if len(self._free) < self.max_free:
+            self._free.append(b)
+        else:
+            libhts.bam_destroy1(b)
+
+    def get(self):
+        try:
+            b = self._free.pop()
+        except IndexError: # empty, or emptied by another thread.
+            b = libhts.bam_init1()
+        return ffi.gc(b, self._release)
+
+    def copy(self, src):
+        b = self.get()
+        libhts.bam_copy1(b, src)
+        return b
+
+_bam1_pool = _Bam1Pool()
+
+# aux type => (htslib getter or array.array typecode for 'B' subtypes).
+_aux_getters = {'Z': libhts.bam_aux2Z, 'H': libhts.bam_aux2Z,
+                'A': libhts.bam_aux2A,
+                'c': libhts.bam_aux2i, 'C': libhts.bam_aux2i,
+                's': libhts.bam_aux2i, 'S': libhts.bam_aux2i,
+                'i': libhts.bam_aux2i, 'I': libhts.bam_aux2i,
+                'f': libhts.bam_aux2f, 'd': libhts.bam_aux2f}
+_aux_array_types = {'c': 'b', 'C': 'B', 's': 'h', 'S': 'H', 'i': 'i', 'I': 'I',
+                    'f': 'f'}
+
+def _aux_value(p):
+    """Python value of the aux data at p (pointing at the type character)."""
+    ftype = chr(p[0])
+    if ftype == 'B':
+        code = _aux_array_types[chr(p[1])]
+        n = ffi.cast("uint32_t *", p + 2)[0]
+        size = array.array(code).itemsize
+        return array.array(code, ffi.buffer(p + 6, n * size)[:])
+    val = _aux_getters[ftype](p)
+    if ftype in 'ZH':
+        return ffi.string(val)
+    return val
+
+class PileupColumn(object):
+
+    """A reference position and the alignments covering it; created by `Bam.pileup`.
+
+    The alignments are only valid until the pileup moves to the next position.
+    """
+    __slots__ = ("chrom", "pos", "depth", "_plp", "_n", "_h")
+
+    def __init__(self, chrom, pos, depth, plp, n, bam_hdr_t):
+        self.chrom, self.pos, self.depth = chrom, pos, depth
+        self._plp, self._n, self._h = plp, n, bam_hdr_t
+
+    @property
+    def alignments(self):
+        """List of (Alignment, query position, is_del) for each read."""
+        plp, h = self._plp, self._h
+        return [(Alignment(plp[i].b, h), plp[i].qpos, bool(plp[i].is_del))
+                for i in range(self._n)]
+
+    def __repr__(self):
+        return "%s('%s:%d', depth=%d)" % (self.__class__.__name__, self.chrom,
+                                          self.pos, self.depth)
+
 class Alignment(object):
 
     """Alignment object; usually created by iterating over a `Bam` object."""
@@ -50,10 +154,11 @@ class Alignment(object):
         self._h = bam_hdr_t
 
     def copy(self):
-        """Create a copy of the alignment for modification or storage."""
-        b = libhts.bam_dup1(self._b)
-        atexit.register(libhts.bam_destroy1, b)
-        return Alignment(b, self._h)
+        """Create a copy of the alignment for modification or storage.
+
+        The copy's memory is recycled as soon as it is no longer referenced.
+        """
+        return Alignment(_bam1_pool.copy(self._b), self._h)
 
     @property
     def tags(self):
@@ -64,28 +169,25 @@ class Alignment(object):
 
         s_aux_ptr = libhts.bam_get_aux(self._b)
         i = 0
-        func = {'Z':libhts.bam_aux2Z, 'A': libhts.bam_aux2Z,
-                'i': libhts.bam_aux2i,
-                'I': libhts.bam_aux2i,
-                'c': libhts.bam_aux2i,
-                'C': libhts.bam_aux2i,
-                'f': libhts.bam_aux2f,
-                'F': libhts.bam_aux2f,
-                's': libhts.bam_aux2i,
-                'S': libhts.bam_aux2i}
-
-        #print(str(self), file=sys.stderr)
         while i < l:
-            key = "".join(chr(s) for s in s_aux_ptr[i:i + 2])
+            key = ffi.buffer(s_aux_ptr + i, 2)[:]
             ftype = chr(s_aux_ptr[i + 2])
-            val = func[ftype](s_aux_ptr[i + 2:i + 2])
-            if ftype in 'ZA':
-                val = ffi.string(val)
-            auxs.append((key, ftype, val))
-            i += 3 + libhts.skip_aux(s_aux_ptr[i + 2:l])
+            auxs.append((key, ftype, _aux_value(s_aux_ptr + i + 2)))
+            i += 3 + libhts.skip_aux(s_aux_ptr + i + 2)
 
         return auxs
 
+    def get_tag(self, tag):
+        """Value of a single auxillary tag; raises KeyError if it is missing.
+
+        Unlike `tags`, this only looks up the requested tag. 'B' arrays are
+        returned as array.array.
+        """
+        p = libhts.bam_aux_get(self._b, tag)
+        if p == ffi.NULL:
+            raise KeyError(tag)
+        return _aux_value(p)
+
     def adjust_overlap_quality(self, other):
         """
         Adjust base-quality of overlapping reads.
@@ -131,8 +233,9 @@ class Alignment(object):
         s = ffi.new('kstring_t *', {'m': 0, 'l': 0, 's': ffi.NULL})
         libhts.kputsn(sam_str, len(sam_str) + 1, s)
 
-        b = libhts.bam_init1()
+        b = _bam1_pool.get()
         res = libhts.sam_parse1(s, bam_hdr, b)
+        libhts.free(s.s)
         assert res <= 0, ("SAM parse error", res)
         h2 = libhts.bam_hdr_dup(bam_hdr)
         return Alignment(b, h2)
@@ -159,10 +262,36 @@ class Alignment(object):
         q_ptr = libhts.bam_get_qual(self._b)
         has_qual = q_ptr[0] != 0xff
         if not has_qual: return None
-        return [q_ptr[i] for i in range(self._b.core.l_qseq)]
+        return list(bytearray(ffi.buffer(q_ptr, self._b.core.l_qseq)))
 
     qual = base_qualities
 
+    @property
+    def qual_view(self):
+        """Base-qualities as a buffer over the alignment's memory (no copy).
+
+        Use e.g. numpy.frombuffer(a.qual_view, dtype=numpy.uint8). Like the
+        `Alignment` itself, the view is only valid until the next read.
+        Missing qualities are 0xff.
+        """
+        return ffi.buffer(libhts.bam_get_qual(self._b), self._b.core.l_qseq)
+
+    @property
+    def seq_view(self):
+        """Buffer over the 4-bit packed sequence (2 bases per byte, no copy)."""
+        return ffi.buffer(libhts.bam_get_seq(self._b), (self._b.core.l_qseq + 1) // 2)
+
+    def seq_into(self, buf):
+        """Decode the sequence into the bytearray `buf` and return its length.
+
+        `buf` is only grown when it is too short so it can be reused across
+        alignments to avoid allocating a new string for each.
+        """
+        n = self._b.core.l_qseq
+        if len(buf) < n:
+            buf.extend(bytearray(n - len(buf)))
+        return libhts.bam_decode_seq(self._b, ffi.from_buffer(buf))
+
     @property
     def pos(self):
         """Left-most position of alignment."""
@@ -211,10 +340,10 @@ class Alignment(object):
     @property
     def seq(self):
         """Nucleotide sequence of read."""
-        kstr = ffi.new('kstring_t *', {'m': 0, 'l': 0, 's': ffi.NULL})
-        r = libhts.bam_get_read_seq(self._b, kstr)
-        assert r == kstr.l, (r, kstr.l)
-        return ffi.string(kstr.s)
+        n = self._b.core.l_qseq
+        buf = ffi.new("char[]", n)
+        libhts.bam_decode_seq(self._b, buf)
+        return ffi.buffer(buf, n)[:]
 
     @property
     def flag_str(self):
@@ -262,10 +391,55 @@ class Bam(object):
         if True, then force create index. If "auto", then only create index
         if it doesn't exist
 
+    index: BamIndex or True, optional
+        an index loaded once and shared between handles, or True to use
+        `BamIndex.cached` (the process-wide cache) after creating a missing
+        index as per `create_index`.
+
     header: bam_hdr_t * or str
         ffi bam_hdr_t object for use when mode == "w"
         or a SAM header string.
 
+    reference: str or Fai, optional
+        fasta used to decode (or, with mode "wc", encode) CRAM. It is
+        available as `bam.reference` for sequence lookups.
+
+    cram_opts: dict, optional
+        CRAM decode options, e.g.
+        {"required_fields": SAM_FLAG | SAM_POS, "decode_md": 0}
+        to skip decoding the fields that are not needed.
+
+    fields: set of str, optional
+        decode hint with the fields that will be used, e.g.
+        {"flag", "pos", "mapq"} (see `Bam.field_bits`). CRAM then only
+        decodes those fields and `read_batch`/`batches` over a BAM read the
+        fixed-size core of each record without decoding the rest. Iterating
+        `Alignment` objects still decodes whole BAM records.
+
+    cache_size: int, optional
+        bytes of decompressed BGZF blocks to cache between region queries.
+        Estimated hits and misses are in `bam.cache_estimate` (see
+        `CacheEstimate`).
+
+    level: int, optional
+        compression level (0-9) when writing, e.g. 1 for fast output.
+        Writing BAM to '-' (stdout) is uncompressed by default.
+
+    threads: int or ThreadPool, optional
+        number of (de)compression threads or a `ThreadPool` shared with
+        other handles.
+
+    copy: bool, optional
+        if True, each `Alignment` from iteration or region queries owns its
+        record so it stays valid after the next read (see `Alignment.copy`).
+        Records are recycled once they are no longer referenced.
+
+    tags: list of str, optional
+        aux tags (e.g. ["RG", "NM"]) to extract as columns in `read_batch`
+        and `batches`. A tag may declare its SAM type (e.g. "XS:Z",
+        "XN:i"). Undeclared tags are strings if they are in
+        `Bam.string_tags` (from the SAM spec) and numeric otherwise.
+
     Examples
     --------
 
@@ -316,14 +490,28 @@ class Bam(object):
     'TACAAATCTTACGTAAACACTCCAAGCATGAATTCG'
     >>> a = asav
 
-    # in the future, we may default to copy semantics or allow that to be specified
-    # when creating a BAM.
+    # or open the Bam with copy=True so every alignment owns its record.
+    >>> cbam = Bam("%s/test/small.bam" % op.dirname(__file__), copy=True)
+    >>> c1, c2 = next(cbam), next(cbam)
+    >>> c1.pos, c2.pos
+    (9329, 10212)
 
     >>> a.flag, a.flag_str
     (16, 'REVERSE')
     >>> a.base_qualities[:10]
     [56, 63, 53, 62, 64, 62, 51, 44, 58, 59]
 
+    # views avoid copying the qualities or the packed sequence.
+    >>> list(bytearray(a.qual_view[:10]))
+    [56, 63, 53, 62, 64, 62, 51, 44, 58, 59]
+    >>> len(a.seq_view)
+    18
+    >>> buf = bytearray()
+    >>> a.seq_into(buf)
+    36
+    >>> bytes(buf[:10])
+    'TACAAATCTT'
+
     >>> a.mapping_quality # or a.mapq
     3
     >>> a.pos
@@ -406,15 +594,65 @@ Writing.
     #>>> assert "HELLO" in str(a)
     """
 
-    def __init__(self, fname, mode="r", create_index="auto", header=None, fasta=None):
+    # array.array typecodes for the columns that read_batch can fill.
+    batch_fields = {"tid": "i", "pos": "i", "mapq": "B", "flag": "H",
+                    "rlen": "i", "qlen": "i", "isize": "i", "mtid": "i",
+                    "pnext": "i"}
+
+    def __init__(self, fname, mode="r", create_index="auto", header=None, fasta=None,
+                 threads=None, tags=None, copy=False, level=None, reference=None,
+                 cram_opts=None, fields=None, cache_size=None, index=None):
+        if mode[0] == "w":
+            mode = Bam._write_mode(fname, mode, level)
         self.fn, self.mode = fname, mode
+        self._copy = copy
+        self._tags, self._tag_kinds = None, {}
+        if tags is not None:
+            assert all(len(t) == 2 or (len(t) == 4 and t[2] == ":") for t in tags), \
+                    ("Bam: bad tags", tags)
+            # b'Z' for list columns, b'f' for array columns; see _read_batch.
+            self._tag_kinds = dict((t[:2], b'Z' if t[3] in "AZH" else b'f') if len(t) == 4
+                                   else (t, b'Z' if t in Bam.string_tags else b'f')
+                                   for t in tags)
+            self._tags = [t[:2] for t in tags]
 
         htf = self._htf = libhts.hts_open(fname, mode)
         _raise_if_null(htf, "Bam: bad file %s" % fname)
+        self._pool = set_threads(htf, threads)
+        self.cache_estimate = set_cache(htf, cache_size) if mode[0] == "r" else None
+
+        if reference is None and "c" in mode and fasta:
+            reference = fasta
+        self.reference = None
+        if reference is not None:
+            self._set_reference(reference)
+        self._skim = False
+        if fields is not None and mode[0] == "r":
+            self._set_fields(fields)
+        if cram_opts:
+            self._set_cram_opts(cram_opts)
 
         if mode[0] == "r":
 
-            idx = self._idx = libhts.sam_index_load(self._htf, fname)
+            if index is True:
+                # create_index applies to the shared index too.
+                if create_index is True:
+                    libhts.bam_index_build(fname, -1)
+                    BamIndex.evict(fname)
+                elif create_index == "auto" and not fname.endswith(".cram"):
+                    try:
+                        index = BamIndex.cached(fname)
+                    except Exception:
+                        libhts.bam_index_build(fname, -1)
+                if index is True:
+                    index = BamIndex.cached(fname)
+            if index is not None:
+                # shared with other handles; kept alive by self._index.
+                self._index, self._idx = index, index._idx
+                create_index = False
+            else:
+                self._idx = libhts.sam_index_load(self._htf, fname)
+            idx = self._idx
             if (idx == ffi.NULL and create_index == "auto") or create_index is True:
                 libhts.bam_index_build(fname, -1)
                 idx = self._idx = libhts.sam_index_load(self._htf, fname)
@@ -424,8 +662,7 @@ Writing.
                     pass
 
             self.header = BamHeader(libhts.sam_hdr_read(htf))
-            b = self._b = libhts.bam_init1()
-            atexit.register(libhts.bam_destroy1, b)
+            self._b = ffi.gc(libhts.bam_init1(), libhts.bam_destroy1)
 
         else:
             assert mode[0] == "w" and (header or fasta)
@@ -439,7 +676,89 @@ Writing.
                 header.text = ffi.new("char[]", header_str)
 
             self.header = header
-            libhts.sam_hdr_write(self._htf, self.header);
+            if libhts.sam_hdr_write(self._htf, self.header) < 0:
+                raise Exception("Bam: error writing header to %s" % fname)
+
+    # options for `cram_opts`. values are ints; see `SAM_*` for the
+    # required_fields bits.
+    cram_options = {"decode_md": libhts.CRAM_OPT_DECODE_MD,
+                    "ignore_md5": libhts.CRAM_OPT_IGNORE_MD5,
+                    "required_fields": libhts.CRAM_OPT_REQUIRED_FIELDS}
+
+    def _set_reference(self, reference):
+        """Use a fasta (path or `Fai`) as the CRAM reference.
+
+        The `Fai` makes sure the .fai exists before htslib loads it and is
+        kept as `self.reference` for sequence lookups.
+        """
+        if not isinstance(reference, Fai):
+            reference = Fai(reference)
+        if libhts.hts_set_fai_filename(self._htf, reference.fn) != 0:
+            raise Exception("Bam: bad reference %s" % reference.fn)
+        self.reference = reference
+
+    def _itr_querys(self, region):
+        qiter = libhts.sam_itr_querys(self._idx, self.header._h, region)
+        if self.cache_estimate is not None:
+            self.cache_estimate.record(qiter)
+        return qiter
+
+    def _itr_queryi(self, tid, beg, end):
+        """Query by tid so sequence names are never parsed as regions."""
+        qiter = libhts.sam_itr_queryi(self._idx, tid, beg, end)
+        if self.cache_estimate is not None:
+            self.cache_estimate.record(qiter)
+        return qiter
+
+    # tags with character or string values in the SAM tags spec; other
+    # undeclared `tags` columns are numeric.
+    string_tags = frozenset(["BC", "BQ", "BZ", "CB", "CC", "CO", "CQ", "CR", "CS",
+                             "CT", "CY", "E2", "FS", "LB", "MC", "MD", "MI", "MM",
+                             "OA", "OC", "OQ", "OX", "PG", "PT", "PU", "Q2", "QT",
+                             "QX", "R2", "RG", "RT", "RX", "SA", "TS", "U2"])
+
+    # SAM_* bits needed to decode each `fields` name.
+    field_bits = {"qname": SAM_QNAME, "flag": SAM_FLAG, "tid": SAM_RNAME,
+                  "pos": SAM_POS, "mapq": SAM_MAPQ, "cigar": SAM_CIGAR,
+                  "rlen": SAM_CIGAR, "qlen": SAM_CIGAR, "mtid": SAM_RNEXT,
+                  "pnext": SAM_PNEXT, "isize": SAM_TLEN, "seq": SAM_SEQ,
+                  "qual": SAM_QUAL, "tags": SAM_AUX}
+
+    def _set_fields(self, fields):
+        """Decode hints: CRAM only decodes these fields and BAM batches
+        without tags are read with a skim of the core of each record."""
+        bits = 0
+        for f in fields:
+            try:
+                bits |= Bam.field_bits[f]
+            except KeyError:
+                raise KeyError("Bam: unknown field %s" % f)
+        if self._tags:
+            bits |= SAM_AUX
+        self._set_cram_opts({"required_fields": bits})
+        self._skim = not self._tags and bool(libhts.bam_can_skim(self._htf))
+
+    def _set_cram_opts(self, opts):
+        for name, value in opts.items():
+            try:
+                opt = Bam.cram_options[name]
+            except KeyError:
+                raise KeyError("Bam: unknown cram option %s" % name)
+            if libhts.hts_set_opt(self._htf, opt, ffi.cast("int", value)) != 0:
+                raise Exception("Bam: unable to set %s=%r" % (name, value))
+
+    @staticmethod
+    def _write_mode(fname, mode, level):
+        """Add the compression level to a write mode.
+
+        Output to stdout ('-') defaults to uncompressed BAM for pipes.
+        """
+        if level is None and fname == "-" and "b" in mode:
+            return mode + "u"
+        if level is not None:
+            assert 0 <= level <= 9, ("Bam: bad compression level", level)
+            return mode + str(level)
+        return mode
 
     def __repr__(self):
         return "Bam('%s', '%s')" % (self.fn, self.mode)
@@ -453,8 +772,40 @@ Writing.
         *alns: bam1_t *
 
         """
+        self.write_many(alns)
+
+    def write_many(self, alns, batch_size=10000):
+        """
+        Write an iterable of alignments to the current file.
+
+        A list or tuple is written in batches of `batch_size` records with
+        one call into C per batch. Other iterables are streamed record by
+        record, as alignments from a `Bam` opened without copy=True share a
+        single record that changes on each read.
+
+        >>> import os.path as op
+        >>> src = Bam("%s/test/small.bam" % op.dirname(__file__), copy=True)
+        >>> out = Bam("out.bam", "wb", header=src.header, level=1, threads=2)
+        >>> out.mode
+        'wb1'
+        >>> alns = list(src)
+        >>> out.write_many(alns, batch_size=3); out.close()
+        >>> [a.pos for a in Bam("out.bam")] == [a.pos for a in alns]
+        True
+        """
+        htf, h = self._htf, self.header
+        if isinstance(alns, (list, tuple)):
+            for i in range(0, len(alns), batch_size):
+                chunk = alns[i:i + batch_size]
+                bs = ffi.new("bam1_t *[]", [a._b for a in chunk])
+                if libhts.bam_write_many(htf, h, bs, len(chunk)) != len(chunk):
+                    raise Exception("Bam: error writing to %s" % self.fn)
+            return
+
+        write1 = libhts.sam_write1
         for aln in alns:
-            assert libhts.sam_write1(self._htf, self.header, aln._b) > 0, "error"
+            if write1(htf, h, aln._b) < 0:
+                raise Exception("Bam: error writing to %s" % self.fn)
 
     @classmethod
     def header_from_fasta(self, fasta, sort_order='unknown'):
@@ -466,7 +817,6 @@ Writing.
         @HD VN:1.0 SO:unknown
         @SQ SN:chr1 LN:46
         """
-        from .fai import Fai
         header = ["@HD\tVN:1.0\tSO:%s" % sort_order]
         for chrom, length in Fai(fasta):
             header.append("@SQ\tSN:%s\tLN:%i" % (chrom, length))
@@ -484,10 +834,15 @@ Writing.
         """Return self as an iterator of alignments."""
         return self
 
+    def _next_b(self):
+        """bam1_t to read the next alignment into."""
+        return _bam1_pool.get() if self._copy else self._b
+
     def next(self):
         """Iterate over all alignments returning Alignment object."""
-        if libhts.sam_read1(self._htf, self.header._h, self._b) >= 0:
-            return Alignment(self._b, self.header._h)
+        b = self._next_b()
+        if libhts.sam_read1(self._htf, self.header._h, b) >= 0:
+            return Alignment(b, self.header._h)
         raise StopIteration()
 
     def __call__(self, region):
@@ -498,13 +853,567 @@ Writing.
         region : str
             region to query, e.g. chr1:1234-5678
         """
-        qiter = libhts.sam_itr_querys(self._idx, self.header._h, region);
+        qiter = self._itr_querys(region)
         try:
-            slen = libhts.sam_itr_next(self._htf, qiter, self._b)
+            b = self._next_b()
+            slen = libhts.sam_itr_next(self._htf, qiter, b)
 
             while slen > 0:
-                yield Alignment(self._b, self.header._h)
-                slen = libhts.sam_itr_next(self._htf, qiter, self._b)
+                yield Alignment(b, self.header._h)
+                b = self._next_b()
+                slen = libhts.sam_itr_next(self._htf, qiter, b)
+
+        finally:
+            libhts.hts_itr_destroy(qiter)
+
+    def pairs(self, region=None, max_buffer=None, flag_filter=0x900):
+        """Generate (first, second) mates of paired reads from a coordinate-sorted file.
+
+        Reads wait in a buffer keyed by name and position until their mate is
+        seen. Once iteration passes a buffered read's mate position the mate
+        can no longer appear, so the read is dropped as an orphan; this keeps
+        the buffer bounded by the reads spanning the current position.
+        Progress is kept in `self.pair_stats` with the number of "pairs",
+        "orphans" and the "max_buffered" and "max_heap" (the eviction heap)
+        high-water marks.
+
+        Parameters
+        ----------
+        region : str, optional
+            region to query, e.g. chr1:1234-5678. Mates outside the region
+            are orphans.
+
+        max_buffer : int, optional
+            if set, the oldest buffered read is dropped (as an orphan) when
+            the buffer grows past this size.
+
+        flag_filter : int
+            skip reads with any of these flags set; by default secondary and
+            supplementary alignments.
+
+        >>> import os.path as op
+        >>> bam = Bam("%s/test/t.sam" % op.dirname(__file__))
+        >>> list(bam.pairs())
+        []
+        >>> sorted(bam.pair_stats.items())
+        [('max_buffered', 2), ('max_heap', 2), ('orphans', 2), ('pairs', 0)]
+        """
+        stats = self.pair_stats = {"pairs": 0, "orphans": 0, "max_buffered": 0,
+                                   "max_heap": 0}
+        waiting = OrderedDict()
+        # (mate position, key) of the buffered reads for eviction.
+        mate_heap = []
+
+        if region is None:
+            qiter = ffi.NULL
+        else:
+            qiter = self._itr_querys(region)
+            _raise_if_null(qiter, "Bam: bad region %s" % region)
+        htf, h = self._htf, self.header._h
+        try:
+            while True:
+                b = _bam1_pool.get()
+                if qiter == ffi.NULL:
+                    if libhts.sam_read1(htf, h, b) < 0:
+                        break
+                elif libhts.sam_itr_next(htf, qiter, b) < 0:
+                    break
+                c = b.core
+                if c.flag & flag_filter or not c.flag & 1:
+                    continue
+
+                here = _sort_key(c.tid, c.pos)
+                while mate_heap and mate_heap[0][0] < here:
+                    if waiting.pop(heapq.heappop(mate_heap)[1], None) is not None:
+                        stats["orphans"] += 1
+                # entries of paired or dropped reads stay in the heap until
+                # their mate position; compact so it is bounded with the buffer.
+                if len(mate_heap) > 2 * max(len(waiting), 16):
+                    mate_heap = [e for e in mate_heap if e[1] in waiting]
+                    heapq.heapify(mate_heap)
+
+                aln = Alignment(b, h)
+                qname = aln.qname
+                first = waiting.pop((qname, c.mtid, c.mpos), None)
+                if first is not None:
+                    stats["pairs"] += 1
+                    yield first, aln
+                    continue
+
+                mate = _sort_key(c.mtid, c.mpos)
+                if mate < here:
+                    # the mate was skipped or is outside the region.
+                    stats["orphans"] += 1
+                    continue
+                key = (qname, c.tid, c.pos)
+                waiting[key] = aln
+                heapq.heappush(mate_heap, (mate, key))
+                if max_buffer is not None and len(waiting) > max_buffer:
+                    waiting.popitem(last=False)
+                    stats["orphans"] += 1
+                stats["max_buffered"] = max(stats["max_buffered"], len(waiting))
+                stats["max_heap"] = max(stats["max_heap"], len(mate_heap))
+
+            stats["orphans"] += len(waiting)
+        finally:
+            if qiter != ffi.NULL:
+                libhts.hts_itr_destroy(qiter)
+
+    def read_batch(self, n=10000, fields=("tid", "pos", "mapq", "flag", "rlen")):
+        """Read up to `n` alignments into columns without creating `Alignment` objects.
+
+        Parameters
+        ----------
+        n : int
+            maximum number of alignments to read.
+
+        fields : sequence of str
+            columns to fill; any of the keys in `Bam.batch_fields`.
+
+        Returns
+        -------
+        dict of field => array.array. The arrays support the buffer protocol
+        so e.g. `numpy.frombuffer(cols['pos'], dtype=numpy.int32)` does not copy.
+        An empty batch indicates the end of the file.
+
+        If the Bam was opened with `tags`, each tag is also a column: an
+        array.array('d') for numeric tags (NaN if missing) or a list for
+        character and string tags (None if missing). The kind of each column
+        is fixed when the Bam is opened (see `tags`); a value of the other
+        kind raises a ValueError.
+
+        >>> import os.path as op
+        >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__))
+        >>> cols = bam.read_batch(5, fields=("pos", "mapq", "flag", "rlen"))
+        >>> sorted(cols)
+        ['flag', 'mapq', 'pos', 'rlen']
+        >>> len(cols['pos'])
+        5
+        >>> cols['pos'][0], cols['mapq'][0], cols['flag'][0], cols['rlen'][0]
+        (9329, 3, 16, 36)
+
+        # with a decode hint, batches over a BAM skim the core of each record.
+        >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__), fields={"pos", "flag"})
+        >>> skim = bam.read_batch(5, fields=("pos", "mapq", "flag", "rlen"))
+        >>> all(skim[f] == cols[f] for f in cols)
+        True
+
+        >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__), tags=["NH", "CC"])
+        >>> cols = bam.read_batch(2, fields=("pos",))
+        >>> list(cols['NH']), cols['CC']
+        ([2.0, 1.0], ['chrX', None])
+        """
+        return self._read_batch(ffi.NULL, n, fields)[1]
+
+    def batches(self, region=None, n=10000, fields=("tid", "pos", "mapq", "flag", "rlen")):
+        """Generate column batches (see `read_batch`) over the file or a region.
+
+        Parameters
+        ----------
+        region : str
+            region to query, e.g. chr1:1234-5678. If None, the remainder of
+            the file is read.
+
+        >>> import os.path as op
+        >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__))
+        >>> n = sum(len(c['pos']) for c in bam.batches('chr2L:9000-11000', n=2))
+        >>> n == len(list(bam('chr2L:9000-11000')))
+        True
+        """
+        if region is None:
+            nread, cols = self._read_batch(ffi.NULL, n, fields)
+            while nread > 0:
+                yield cols
+                nread, cols = self._read_batch(ffi.NULL, n, fields)
+            return
+
+        qiter = self._itr_querys(region)
+        _raise_if_null(qiter, "Bam: bad region %s" % region)
+        try:
+            nread, cols = self._read_batch(qiter, n, fields)
+            while nread > 0:
+                yield cols
+                nread, cols = self._read_batch(qiter, n, fields)
+        finally:
+            libhts.hts_itr_destroy(qiter)
+
+    def _read_batch(self, qiter, n, fields):
+        """Return (number of alignments read, dict of columns)."""
+        ccols = ffi.new("bam_columns_t *")
+        cols = {}
+        for f in fields:
+            code = Bam.batch_fields[f]
+            cols[f] = arr = array.array(code, [0]) * n
+            ctype = ffi.typeof(getattr(ccols, f))
+            setattr(ccols, f, ffi.cast(ctype, ffi.from_buffer(arr)))
+
+        tags = self._tags
+        if tags:
+            nums = [array.array('d', [0]) * n for _ in tags]
+            ctags = ffi.new("char[]", "".join(tags))
+            ctypes = ffi.new("char[]", len(tags))
+            cnums = ffi.new("double *[]", [ffi.cast("double *", ffi.from_buffer(a)) for a in nums])
+            cstrs = ffi.new("kstring_t[]", len(tags))
+            ccols.n_tags, ccols.tags, ccols.tag_types = len(tags), ctags, ctypes
+            ccols.tag_nums, ccols.tag_strs = cnums, cstrs
+
+        if self._skim and qiter == ffi.NULL:
+            buf = ffi.new("kstring_t *")
+            nread = libhts.bam_skim_columns(self._htf, ccols, n, buf)
+            libhts.free(buf.s)
+        else:
+            nread = libhts.bam_read_columns(self._htf, self.header._h, qiter,
+                                            self._b, ccols, n)
+        if nread < -1:
+            raise Exception("Bam: error reading %s" % self.fn)
+        if nread < n:
+            for f in fields:
+                cols[f] = cols[f][:nread]
+
+        try:
+            for t, tag in enumerate(tags or ()):
+                kind = self._tag_kinds[tag]
+                if ctypes[t] not in (b'\0', kind):
+                    raise ValueError("Bam: tag %s has %s values; declare it as '%s:%s'"
+                                     % ((tag, "string", tag, "Z") if ctypes[t] == b'Z'
+                                        else (tag, "numeric", tag, "f")))
+                if kind == b'Z':
+                    vals = ffi.buffer(cstrs[t].s, cstrs[t].l)[:].split(b'\0')
+                    cols[tag] = [v or None for v in vals[:nread]]
+                else:
+                    cols[tag] = nums[t][:nread] if nread < n else nums[t]
+        finally:
+            for t in range(len(tags or ())):
+                libhts.free(cstrs[t].s)
+        return nread, cols
+
+    def _parse_region(self, region):
+        """Return (tid, beg, end) with 0-based, half-open coordinates."""
+        # a whole sequence, whose name may contain ':' (e.g. HLA-A*01:01).
+        tid = libhts.bam_name2id(self.header._h, region)
+        if tid >= 0:
+            return tid, 0, self.header._h.target_len[tid]
+        creg = ffi.new("char[]", region)
+        beg, end = ffi.new("int *"), ffi.new("int *")
+        e = libhts.hts_parse_reg(creg, beg, end)
+        _raise_if_null(e, "Bam: bad region %s" % region)
+        chrom = region[:e - creg]
+        tid = libhts.bam_name2id(self.header._h, chrom)
+        if tid < 0:
+            raise KeyError("Bam: unknown sequence %s" % chrom)
+        return tid, beg[0], min(end[0], self.header._h.target_len[tid])
+
+    def pileup(self, region, min_mapq=0, min_baseq=0, flag_filter=0x704,
+               overlap_adjust=True, depth=False):
+        """Pileup of the alignments in a region using htslib's pileup engine.
+
+        Parameters
+        ----------
+        region : str
+            region to query, e.g. chr1:1234-5678
+
+        min_mapq : int
+            skip alignments with a lower mapping quality.
+
+        min_baseq : int
+            do not count bases with a lower base quality in the depth.
 
+        flag_filter : int
+            skip alignments with any of these flags set. The default skips
+            unmapped, secondary, qc-fail and duplicate reads.
+
+        overlap_adjust : bool
+            if True, the bases where the 2 reads of a pair overlap are only
+            counted once (the mate's base quality is set to 0).
+
+        depth : bool
+            if True return an array.array of the depth at each position of the
+            region (0-based, half-open); otherwise generate a `PileupColumn`
+            per covered position.
+
+        >>> import os.path as op
+        >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__))
+        >>> columns = bam.pileup('chr2L:9330-9340', flag_filter=0)
+        >>> col = next(columns)
+        >>> col
+        PileupColumn('chr2L:9329', depth=1)
+        >>> aln, qpos, is_del = col.alignments[0]
+        >>> aln.pos, qpos, is_del
+        (9329, 0, False)
+
+        >>> depths = [c.depth for c in bam.pileup('chr2L:9330-9340', flag_filter=0)]
+        >>> len(depths)
+        11
+        >>> d = bam.pileup('chr2L:9320-9340', flag_filter=0, depth=True)
+        >>> list(d[:12])
+        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1]
+        >>> list(d[10:]) == depths
+        True
+        """
+        tid, beg, end = self._parse_region(region)
+        if overlap_adjust:
+            min_baseq = max(min_baseq, 1)
+
+        qiter = self._itr_queryi(tid, beg, end)
+        _raise_if_null(qiter, "Bam: bad region %s" % region)
+        aux = ffi.new("plp_aux_t *")
+        aux.fp, aux.h, aux.itr = self._htf, self.header._h, qiter
+        aux.min_mapq, aux.flag_filter = min_mapq, flag_filter
+        plp_iter = libhts.plp_init(aux, int(bool(overlap_adjust)))
+
+        if depth:
+            try:
+                arr = array.array("i", [0]) * (end - beg)
+                if libhts.plp_fill_depth(plp_iter, tid, beg, end, min_baseq,
+                        ffi.cast("int32_t *", ffi.from_buffer(arr))) < 0:
+                    raise Exception("Bam: error in pileup of %s" % region)
+                return arr
+            finally:
+                libhts.bam_mplp_destroy(plp_iter)
+                libhts.hts_itr_destroy(qiter)
+        return self._pileup_columns(aux, plp_iter, tid, beg, end, min_baseq)
+
+    def _pileup_columns(self, aux, plp_iter, tid, beg, end, min_baseq):
+        ptid, ppos, n = ffi.new("int *"), ffi.new("int *"), ffi.new("int *")
+        plp = ffi.new("bam_pileup1_t **")
+        chrom = ffi.string(self.header._h.target_name[tid])
+        try:
+            while libhts.bam_mplp_auto(plp_iter, ptid, ppos, n, plp) > 0:
+                if ptid[0] != tid or ppos[0] < beg:
+                    continue
+                if ppos[0] >= end:
+                    break
+                d = libhts.plp_depth(plp[0], n[0], min_baseq)
+                yield PileupColumn(chrom, ppos[0], d, plp[0], n[0], self.header._h)
+        finally:
+            libhts.bam_mplp_destroy(plp_iter)
+            libhts.hts_itr_destroy(aux.itr)
+
+    def coverage(self, chrom, window=None, min_mapq=0, exclude_flags=0x704):
+        """Per-base depth of `chrom` using a cumulative sum over read starts/ends.
+
+        This is much faster than `pileup` as it only considers the cigar of
+        each read. Bases in deletions and ref-skips are not counted and mate
+        overlap is not adjusted.
+
+        Parameters
+        ----------
+        chrom : str
+            sequence name from the header.
+
+        window : int, optional
+            if given, return the mean depth in each consecutive window.
+
+        min_mapq : int
+            skip alignments with a lower mapping quality.
+
+        exclude_flags : int
+            skip alignments with any of these flags set. The default skips
+            unmapped, secondary, qc-fail and duplicate reads.
+
+        Returns
+        -------
+        array.array('i') of the depth at each base of `chrom` or
+        array.array('d') of window means.
+
+        >>> import os.path as op
+        >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__))
+        >>> cov = bam.coverage('chr2L')
+        >>> len(cov)
+        23011544
+        >>> list(cov[9328:9331]), list(cov[10519:10523])
+        ([0, 1, 1], [1, 1, 2, 2])
+        >>> list(cov[9300:9400]) == list(bam.pileup('chr2L:9301-9400', flag_filter=0x704,
+        ...                                          overlap_adjust=False, depth=True))
+        True
+        >>> means = bam.coverage('chr2L', window=1000)
+        >>> len(means), means[9]
+        (23012, 0.036)
+        """
+        tid = libhts.bam_name2id(self.header._h, chrom)
+        if tid < 0:
+            raise KeyError("Bam: unknown sequence %s" % chrom)
+        tlen = self.header._h.target_len[tid]
+
+        qiter = self._itr_queryi(tid, 0, tlen)
+        _raise_if_null(qiter, "Bam: unable to query %s" % chrom)
+        depth = array.array("i", [0]) * tlen
+        try:
+            if libhts.bam_coverage(self._htf, qiter, self._b, tid, min_mapq, exclude_flags,
+                    ffi.cast("int32_t *", ffi.from_buffer(depth)), tlen) < -1:
+                raise Exception("Bam: error reading %s" % self.fn)
         finally:
             libhts.hts_itr_destroy(qiter)
+        if window is None:
+            return depth
+
+        means = array.array("d", [0]) * ((tlen + window - 1) // window)
+        libhts.window_means(ffi.cast("int32_t *", ffi.from_buffer(depth)), tlen, window,
+                            ffi.cast("double *", ffi.from_buffer(means)))
+        return means
+
+    # keys of `flagstat` in the order samtools reports them.
+    flagstat_keys = ("total", "secondary", "supplementary", "duplicates", "mapped",
+                     "paired", "read1", "read2", "proper_pair", "both_mapped",
+                     "singletons", "mate_diff_chr", "mate_diff_chr_mapq5")
+
+    def flagstat(self, region=None, threads=None):
+        """Count alignments by flag, as `samtools flagstat`, without leaving C.
+
+        A new handle is opened on the file so the position of this `Bam`
+        is unchanged.
+
+        Parameters
+        ----------
+        region : str, optional
+            region to query, e.g. chr1:1234-5678. If None, the whole file.
+
+        threads: int or ThreadPool, optional
+            decompression threads for the pass over the file.
+
+        Returns
+        -------
+        dict of key (see `Bam.flagstat_keys`) => (qc-passed, qc-failed).
+
+        >>> import os.path as op
+        >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__))
+        >>> fs = bam.flagstat(threads=2)
+        >>> fs['total'], fs['mapped'], fs['paired']
+        ((10, 0), (10, 0), (0, 0))
+        >>> bam.flagstat('chr2L:9000-11000')['total'][0] == len(list(bam('chr2L:9000-11000')))
+        True
+        """
+        htf = libhts.hts_open(self.fn, "r")
+        _raise_if_null(htf, "Bam: bad file %s" % self.fn)
+        pool = set_threads(htf, threads)
+        qiter, h, idx = ffi.NULL, ffi.NULL, ffi.NULL
+        try:
+            if self.reference is not None:
+                libhts.hts_set_fai_filename(htf, self.reference.fn)
+            bits = SAM_FLAG | SAM_RNAME | SAM_RNEXT | SAM_MAPQ
+            if region is not None:
+                bits |= SAM_POS | SAM_CIGAR
+            libhts.hts_set_opt(htf, libhts.CRAM_OPT_REQUIRED_FIELDS, ffi.cast("int", bits))
+            h = libhts.sam_hdr_read(htf)
+            _raise_if_null(h, "Bam: bad header in %s" % self.fn)
+            if region is not None:
+                # a CRAM index belongs to the handle it was loaded on, so
+                # the index of this Bam can not be used with htf.
+                idx = libhts.sam_index_load(htf, self.fn)
+                _raise_if_null(idx, "Bam: no index for %s" % self.fn)
+                qiter = libhts.sam_itr_querys(idx, h, region)
+                _raise_if_null(qiter, "Bam: bad region %s" % region)
+
+            stats = ffi.new("bam_flagstat_t *")
+            b = ffi.gc(libhts.bam_init1(), libhts.bam_destroy1)
+            if libhts.bam_flagstat(htf, h, qiter, b, stats) < 0:
+                raise Exception("Bam: error reading %s" % self.fn)
+        finally:
+            if qiter != ffi.NULL:
+                libhts.hts_itr_destroy(qiter)
+            if idx != ffi.NULL:
+                libhts.hts_idx_destroy(idx)
+            if h != ffi.NULL:
+                libhts.bam_hdr_destroy(h)
+            libhts.hts_close(htf)
+            del pool
+        return OrderedDict((k, tuple(getattr(stats, k))) for k in Bam.flagstat_keys)
+
+    def idxstats(self):
+        """Mapped and unmapped counts per sequence, read from the index.
+
+        Returns
+        -------
+        list of (chrom, length, mapped, unmapped) with a final
+        ('*', 0, 0, n) for the unmapped reads without coordinates, as
+        `samtools idxstats`.
+
+        >>> import os.path as op
+        >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__))
+        >>> bam.idxstats()[0]
+        ('chr2L', 23011544, 10, 0)
+        >>> sum(m + u for _, _, m, u in bam.idxstats()) == bam.flagstat()['total'][0]
+        True
+        """
+        _raise_if_null(self._idx, "Bam: no index for %s" % self.fn)
+        mapped, unmapped = ffi.new("uint64_t *"), ffi.new("uint64_t *")
+        h = self.header._h
+        stats = []
+        for tid in range(h.n_targets):
+            if libhts.hts_idx_get_stat(self._idx, tid, mapped, unmapped) < 0:
+                mapped[0] = unmapped[0] = 0
+            stats.append((ffi.string(h.target_name[tid]), h.target_len[tid],
+                          int(mapped[0]), int(unmapped[0])))
+        stats.append(("*", 0, 0, int(libhts.hts_idx_get_n_no_coor(self._idx))))
+        return stats
+
+class MultiBam(object):
+
+    r"""
+    Merge alignments from several coordinate-sorted files in (tid, pos) order.
+
+    Only the current alignment of each file is held, so memory is O(files).
+    All files must have the same sequences in the same order.
+
+    Parameters
+    ----------
+
+    paths : list of str
+        bam (or sam/cram) files.
+
+    region : str, optional
+        only merge the alignments in this region, e.g. chr1:1234-5678.
+
+    threads : int or ThreadPool, optional
+        an int gives each file its own decompression threads while a
+        `ThreadPool` is shared by all of the files.
+
+    Examples
+    --------
+
+    >>> import os.path as op
+    >>> path = "%s/test/small.bam" % op.dirname(__file__)
+    >>> mb = MultiBam([path, path], 'chr2L:10000-10500')
+    >>> [(i, a.pos) for i, a in mb]
+    [(0, 10212), (1, 10212), (0, 10255), (1, 10255), (0, 10427), (1, 10427), (0, 10474), (1, 10474)]
+    """
+
+    def __init__(self, paths, region=None, threads=None):
+        self.paths, self.region = list(paths), region
+        self.bams = [Bam(p, threads=threads) for p in self.paths]
+        seqs = list(self.bams[0].header.seqs)
+        for path, bam in zip(self.paths[1:], self.bams[1:]):
+            if list(bam.header.seqs) != seqs:
+                raise ValueError("MultiBam: sequences in %s differ from %s" % (path, self.paths[0]))
+        self.header = self.bams[0].header
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.paths)
+
+    def __iter__(self):
+        return self(self.region)
+
+    def __call__(self, region=None):
+        """Generate (file index, Alignment) in coordinate order.
+
+        Each alignment is only valid until its file is advanced, i.e. until
+        the next item is requested.
+        """
+        sources = [bam(region) if region else iter(bam) for bam in self.bams]
+        heap = []
+        for i, src in enumerate(sources):
+            for aln in src:
+                c = aln._b.core
+                heap.append((_sort_key(c.tid, c.pos), i, aln))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            _, i, aln = heap[0]
+            yield i, aln
+            for aln in sources[i]:
+                c = aln._b.core
+                heapq.heapreplace(heap, (_sort_key(c.tid, c.pos), i, aln))
+                break
+            else:
+                heapq.heappop(heap)
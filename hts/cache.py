@@ -0,0 +1,91 @@
+from .htsffi import libhts, ffi
+from collections import OrderedDict
+
+# BGZF_MAX_BLOCK_SIZE in htslib/bgzf.h
+BGZF_BLOCK_SIZE = 0x10000
+
+
+class CacheEstimate(object):
+
+    """
+    Estimated hit/miss counts for the BGZF block cache of a `Bam`, `Tbx` or
+    `VCF` opened with `cache_size`.
+
+    These are not counts of htslib's own cache loads: htslib only caches
+    decompressed blocks when it is built with -DBGZF_CACHE (`enabled` tells
+    whether it does) and then evicts blocks in hash order rather than by
+    age. The counts come from an LRU of the same capacity that records the
+    first and last block of each index chunk of every region query, so they
+    estimate how well a cache of that size suits the workload.
+
+    Examples
+    --------
+
+    >>> import os.path as op
+    >>> from hts import Bam
+    >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__), cache_size=1 << 20)
+    >>> bam.cache_estimate
+    CacheEstimate(size=1048576, hits=0, misses=0)
+    >>> _ = list(bam('chr2L:9000-11000')), list(bam('chr2L:9000-9500'))
+    >>> bam.cache_estimate.hits, bam.cache_estimate.misses
+    (2, 2)
+    >>> bam.cache_estimate.hit_rate
+    0.5
+    """
+
+    def __init__(self, cache_size, enabled):
+        self.cache_size, self.enabled = cache_size, enabled
+        self.hits = self.misses = 0
+        self._max_blocks = max(1, cache_size // BGZF_BLOCK_SIZE)
+        self._blocks = OrderedDict()
+        self._buf = ffi.new("int64_t[]", 64)
+
+    def record(self, itr):
+        """Count the blocks of a new query iterator as estimated hits or
+        misses."""
+        if itr == ffi.NULL:
+            return
+        n = libhts.hts_itr_blocks(itr, self._buf, len(self._buf))
+        if n > len(self._buf):
+            self._buf = ffi.new("int64_t[]", n)
+            n = libhts.hts_itr_blocks(itr, self._buf, n)
+        blocks, seen = self._blocks, set()
+        for i in range(n):
+            b = self._buf[i]
+            if b in seen:
+                continue
+            seen.add(b)
+            if b in blocks:
+                self.hits += 1
+                del blocks[b]
+            else:
+                self.misses += 1
+                if len(blocks) >= self._max_blocks:
+                    blocks.popitem(last=False)
+            blocks[b] = True
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+    def reset(self):
+        self.hits = self.misses = 0
+
+    def __repr__(self):
+        return "%s(size=%d, hits=%d, misses=%d)" % (self.__class__.__name__,
+                self.cache_size, self.hits, self.misses)
+
+
+def set_cache(htf, cache_size):
+    """Set the block cache of an open htsFile to `cache_size` bytes.
+
+    Returns a `CacheEstimate` (or None if cache_size is not set) for the
+    caller to `record` each region query.
+    """
+    if not cache_size:
+        return None
+    enabled = libhts.hts_set_block_cache(htf, int(cache_size))
+    if enabled < 0:
+        raise Exception("cache_size is only supported for BGZF compressed files")
+    return CacheEstimate(int(cache_size), bool(enabled))
@@ -1,4 +1,5 @@
 from .htsffi import libhts, ffi
+import array
 import os.path as op
 import atexit
 
@@ -63,11 +64,124 @@ class Fai(object):
         """
         rlen = ffi.new("int *")
         seq = libhts.fai_fetch(self._fai, region, rlen)
-        if rlen == -2:
+        if rlen[0] == -2:
             raise Exception("sequence not present")
-        elif rlen == -1:
+        elif rlen[0] < 0 or seq == ffi.NULL:
             raise Exception("error fetching sequence")
-        return ffi.string(seq)
+        try:
+            return ffi.buffer(seq, rlen[0])[:]
+        finally:
+            libhts.free(seq)
+
+    def fetch(self, chrom, start, end, out=None, encoding=None):
+        """Extract chrom:start-end using 0-based, half-open coordinates.
+
+        Arguments
+        ---------
+
+        chrom: str
+
+        start, end: int
+            end is clipped to the length of the sequence.
+
+        out: writable buffer, optional
+            e.g. a bytearray or array.array('B') of at least `end - start`
+            bytes (`(end - start + 3) // 4` for "2bit") that is filled
+            instead of allocating a new result. The number of bases is
+            returned.
+
+        encoding: str, optional
+            None for the sequence as a str, "uint8" for an array.array('B')
+            with A=0, C=1, G=2, T=3 and 4 for anything else, or "2bit" for
+            4 bases per byte (first base in the high bits, N stored as A).
+
+        Examples
+        --------
+
+        >>> f = Fai('%s/test/t.fa' % op.dirname(__file__))
+        >>> f.fetch('chr1', 0, 10)
+        'AGAAAACCCC'
+        >>> list(f.fetch('chr1', 0, 4, encoding="uint8"))
+        [0, 2, 0, 0]
+        >>> list(f.fetch('chr1', 0, 4, encoding="2bit"))
+        [32]
+        >>> buf = bytearray(10)
+        >>> f.fetch('chr1', 40, 50, out=buf), bytes(buf[:6])
+        (6, 'TTTTTT')
+        """
+        enc = self._encodings[encoding]
+        if out is None:
+            size = max(0, end - start)
+            res = bytearray(size) if enc == libhts.FAI_ENC_NONE else array.array('B', [0]) * size
+            n = self._fetch_into(chrom, start, end, res, enc)
+            if enc == libhts.FAI_ENC_2BIT:
+                n = (n + 3) // 4
+            return bytes(res[:n]) if enc == libhts.FAI_ENC_NONE else res[:n]
+        cout = ffi.from_buffer(out)
+        need = max(0, end - start)
+        if enc == libhts.FAI_ENC_2BIT:
+            need = (need + 3) // 4
+        if len(cout) < need:
+            raise ValueError("Fai: out holds %d bytes, need %d" % (len(cout), need))
+        return self._fetch_into(chrom, start, end, cout, enc)
+
+    def fetch_many(self, regions, encoding=None):
+        """Extract many (chrom, start, end) regions (0-based, half-open).
+
+        With `encoding` None, a list of str is returned. Otherwise, the
+        encoded regions (see `fetch`) are written back to back to a single
+        array.array('B') and (codes, offsets) is returned where region i is
+        codes[offsets[i]:offsets[i + 1]].
+
+        Examples
+        --------
+
+        >>> f = Fai('%s/test/t.fa' % op.dirname(__file__))
+        >>> f.fetch_many([('chr1', 0, 3), ('chr1', 10, 12)])
+        ['AGA', 'CC']
+        >>> codes, offsets = f.fetch_many([('chr1', 0, 3), ('chr1', 10, 12)], encoding="uint8")
+        >>> list(codes), list(offsets)
+        ([0, 2, 0, 1, 1], [0, 3, 5])
+        """
+        enc = self._encodings[encoding]
+        regions = list(regions)
+        per_base = enc != libhts.FAI_ENC_2BIT
+        sizes = [max(0, e - s) if per_base else (max(0, e - s) + 3) // 4
+                 for _, s, e in regions]
+        if enc == libhts.FAI_ENC_NONE:
+            buf = bytearray(max(sizes or [0]))
+            cbuf = ffi.from_buffer(buf)
+            seqs = []
+            for chrom, start, end in regions:
+                n = self._fetch_into(chrom, start, end, cbuf, enc)
+                seqs.append(bytes(buf[:n]))
+            return seqs
+
+        codes = array.array('B', [0]) * sum(sizes)
+        offsets = array.array('i', [0])
+        cbuf = ffi.cast("uint8_t *", ffi.from_buffer(codes))
+        off = 0
+        for chrom, start, end in regions:
+            n = self._fetch_into(chrom, start, end, cbuf + off, enc)
+            off += n if per_base else (n + 3) // 4
+            offsets.append(off)
+        if off < len(codes):
+            codes = codes[:off]
+        return codes, offsets
+
+    _encodings = {None: libhts.FAI_ENC_NONE, "uint8": libhts.FAI_ENC_UINT8,
+                  "2bit": libhts.FAI_ENC_2BIT}
+
+    def _fetch_into(self, chrom, start, end, out, enc):
+        if not isinstance(out, ffi.CData):
+            out = ffi.from_buffer(out)
+        n = libhts.fai_fetch_into(self._fai, chrom, start, end,
+                                  ffi.cast("uint8_t *", out), enc)
+        if n == -2:
+            raise KeyError("sequence not present: %s" % chrom)
+        elif n < 0:
+            raise Exception("error fetching sequence")
+        return n
 
     @property
     def nseqs(self):
@@ -57,6 +57,43 @@ char **hts_readlines(const char *fn, int *_n);
 int hts_set_threads(htsFile *fp, int n);
 int hts_set_fai_filename(htsFile *fp, const char *fn_aux);
 
+enum sam_fields {
+    SAM_QNAME = 0x00000001,
+    SAM_FLAG  = 0x00000002,
+    SAM_RNAME = 0x00000004,
+    SAM_POS   = 0x00000008,
+    SAM_MAPQ  = 0x00000010,
+    SAM_CIGAR = 0x00000020,
+    SAM_RNEXT = 0x00000040,
+    SAM_PNEXT = 0x00000080,
+    SAM_TLEN  = 0x00000100,
+    SAM_SEQ   = 0x00000200,
+    SAM_QUAL  = 0x00000400,
+    SAM_AUX   = 0x00000800,
+    SAM_RGAUX = 0x00001000,
+};
+
+enum hts_fmt_option {
+    CRAM_OPT_DECODE_MD,
+    CRAM_OPT_IGNORE_MD5,
+    CRAM_OPT_REQUIRED_FIELDS,
+    ...
+};
+
+int hts_set_opt(htsFile *fp, enum hts_fmt_option opt, ...);
+
+struct hts_tpool;
+typedef struct hts_tpool hts_tpool;
+
+typedef struct {
+    hts_tpool *pool; // The shared thread pool itself
+    int qsize;       // Size of I/O queue to use for this fp
+} htsThreadPool;
+
+hts_tpool *hts_tpool_init(int n);
+void hts_tpool_destroy(hts_tpool *p);
+int hts_set_thread_pool(htsFile *fp, htsThreadPool *p);
+
 typedef int hts_readrec_func(BGZF *fp, void *data, void *r, int *tid, int *beg, int *end);
 typedef const char *(*hts_id2name_f)(void*, int);
 
@@ -158,6 +195,7 @@ typedef struct {
 
 bam_hdr_t *sam_hdr_parse(int l_text, const char *text);
 bam_hdr_t *sam_hdr_read(samFile *fp);
+void bam_hdr_destroy(bam_hdr_t *h);
 bam_hdr_t* bam_hdr_dup(const bam_hdr_t *h0);
 int bam_hdr_write(BGZF *fp, const bam_hdr_t *h);
 int sam_hdr_write(htsFile *fp, const bam_hdr_t *h);
@@ -186,6 +224,7 @@ int bam_get_l_aux(bam1_t *b);
 uint8_t *bam_aux_get(const bam1_t *b, const char tag[2]);
 int32_t bam_aux2i(const uint8_t *s);
 float bam_aux2f(const uint8_t *s);
+char bam_aux2A(const uint8_t *s);
 char *bam_aux2Z(const uint8_t *s);
 
 bam1_t *bam_copy1(bam1_t *bdst, const bam1_t *bsrc);
@@ -199,6 +238,7 @@ int   bam_str2flag(const char *str);    /** returns negative value on error */
 char *bam_flag2str(int flag);   /** The string must be freed by the user */
 
 int sam_parse1(kstring_t *s, bam_hdr_t *h, bam1_t *b);
+int bam_name2id(bam_hdr_t *h, const char *ref);
 
 
 
@@ -207,6 +247,7 @@ int bam_index_build(const char *fn, int min_shift);
 
 
 hts_itr_t * sam_itr_querys(hts_idx_t*, bam_hdr_t *h, char * region);
+hts_itr_t * sam_itr_queryi(const hts_idx_t *idx, int tid, int beg, int end);
 
 //int tbx_itr_next(htsFile *fp, tbx_t *tbx, hts_itr_t *iter, void *data);
 int sam_itr_next(htsFile *fp, hts_itr_t *iter, void *data);
@@ -344,6 +385,7 @@ typedef struct {
 
 typedef struct {
 	int32_t n[3];
+	char **samples;
 	...;
 } bcf_hdr_t;
 
@@ -379,20 +421,36 @@ typedef struct {
 
 
 bcf1_t *bcf_init(void);
+void bcf_destroy(bcf1_t *v);
 
 
 
 bcf_hdr_t *bcf_hdr_read(htsFile *fp);
 int bcf_hdr_set_samples(bcf_hdr_t *hdr, const char *samples, int is_file);
+int bcf_subset_format(const bcf_hdr_t *hdr, bcf1_t *rec);
 
 int bcf_read(htsFile *fp, const bcf_hdr_t *h, bcf1_t *v);
+int bcf_write(htsFile *fp, bcf_hdr_t *h, bcf1_t *v);
+int bcf_hdr_write(htsFile *fp, bcf_hdr_t *h);
+bcf_hdr_t *bcf_hdr_dup(const bcf_hdr_t *hdr);
 
 static inline const char *bcf_hdr_id2name(const bcf_hdr_t *hdr, int rid);
 
 int bcf_unpack(bcf1_t *b, int which);
 
+hts_idx_t *bcf_index_load(const char *fn);
+int bcf_index_build(const char *fn, int min_shift);
+hts_itr_t *bcf_itr_querys(const hts_idx_t *idx, const bcf_hdr_t *hdr, const char *s);
+
 static const int BCF_DT_SAMPLE = 2;
 
+static const int BCF_UN_STR  = 1;       // up to ALT inclusive
+static const int BCF_UN_FLT  = 2;       // up to FILTER
+static const int BCF_UN_INFO = 4;       // up to INFO
+static const int BCF_UN_SHR  = 7;       // all shared information
+static const int BCF_UN_FMT  = 8;       // unpack format and each sample
+static const int BCF_UN_ALL  = 15;      // everything
+
 int bcf_get_genotypes(const bcf_hdr_t *hdr, bcf1_t *line, int **dst, int *ndst);
 int bcf_get_format_values(const bcf_hdr_t *hdr, bcf1_t *line, const char *tag, void **dst, int *ndst, int type);
 //typedef htsFile vcfFile;
@@ -1,6 +1,12 @@
+#include <limits.h>
+#include <math.h>
 #include "htslib/sam.h"
+#include "htslib/bgzf.h"
 #include "htslib/vcf.h"
 #include "htslib/kstring.h"
+#include "htslib/tbx.h"
+#include "htslib/faidx.h"
+#include "hts_extra.h"
 
 
 // the htslib api only provides bam_seqi to get one base at a time.
@@ -14,6 +20,15 @@ int bam_get_read_seq(bam1_t *b, kstring_t * str){
     return i;
 }
 
+// decode the sequence into a caller-owned buffer of at least l_qseq bytes
+// so that repeated calls can reuse the same memory.
+int bam_decode_seq(bam1_t *b, char *out){
+    int i = 0;
+    uint8_t *s = bam_get_seq(b);
+    for (; i < b->core.l_qseq; ++i) out[i] = "=ACMGRSVTWYHKDBN"[bam_seqi(s, i)];
+    return i;
+}
+
 int as_gts(int *gts, int num_samples) {
 	int j = 0, i;
 	for (i = 0; i < 2 * num_samples; i += 2){
@@ -190,7 +205,7 @@ int skip_aux(uint8_t *s)
         size = aux_type2size(*s);
 		++s;
         memcpy(&n, s, 4); s += 4;
-        return n * size + 4;
+        return n * size + 5; // subtype, count and values
     case 0:
         abort();
         break;
@@ -199,3 +214,540 @@ int skip_aux(uint8_t *s)
     }
 }
 
+
+// fill row i of the tag columns: numeric tags go to tag_nums (NaN if
+// missing) and character/string tags are appended to tag_strs, each value
+// followed by a '\0' (an empty value if missing). tag_types records 'f' or
+// 'Z' for each tag seen so python knows which column to use.
+static void bam_fill_tags(bam1_t *b, bam_columns_t *cols, int i) {
+    int t;
+    for (t = 0; t < cols->n_tags; ++t) {
+        uint8_t *p = bam_aux_get(b, cols->tags + 2 * t);
+        kstring_t *str = &cols->tag_strs[t];
+        cols->tag_nums[t][i] = NAN;
+        if (p != NULL) {
+            switch (*p) {
+            case 'Z': case 'H':
+                kputs((char *)p + 1, str); cols->tag_types[t] = 'Z'; break;
+            case 'A':
+                kputc(p[1], str); cols->tag_types[t] = 'Z'; break;
+            case 'f': case 'd':
+                cols->tag_nums[t][i] = bam_aux2f(p); cols->tag_types[t] = 'f'; break;
+            case 'c': case 'C': case 's': case 'S': case 'i': case 'I':
+                cols->tag_nums[t][i] = bam_aux2i(p); cols->tag_types[t] = 'f'; break;
+            }
+        }
+        kputc('\0', str);
+    }
+}
+
+// fill up to n rows of the requested columns (NULL columns are skipped) with
+// the core fields of the next alignments. if itr is NULL, reads sequentially
+// otherwise from the region iterator. this avoids creating a python object
+// and crossing the ffi boundary for every field of every alignment.
+// returns the number of rows filled or < -1 on error.
+int bam_read_columns(htsFile *fp, bam_hdr_t *h, hts_itr_t *itr, bam1_t *b,
+                     bam_columns_t *cols, int n) {
+    int i = 0, r;
+    for (; i < n; ++i) {
+        r = itr == NULL ? sam_read1(fp, h, b) : sam_itr_next(fp, itr, b);
+        if (r < 0) return r < -1 ? r : i;
+        bam1_core_t *c = &b->core;
+        if (cols->tid)   cols->tid[i]   = c->tid;
+        if (cols->pos)   cols->pos[i]   = c->pos;
+        if (cols->mapq)  cols->mapq[i]  = c->qual;
+        if (cols->flag)  cols->flag[i]  = c->flag;
+        if (cols->rlen)  cols->rlen[i]  = bam_cigar2rlen(c->n_cigar, bam_get_cigar(b));
+        if (cols->qlen)  cols->qlen[i]  = bam_cigar2qlen(c->n_cigar, bam_get_cigar(b));
+        if (cols->isize) cols->isize[i] = c->isize;
+        if (cols->mtid)  cols->mtid[i]  = c->mtid;
+        if (cols->pnext) cols->pnext[i] = c->mpos;
+        if (cols->n_tags) bam_fill_tags(b, cols, i);
+    }
+    return i;
+}
+
+// true if records can be read with bam_skim_columns: uncompressed or
+// bgzipped BAM on a little-endian machine.
+int bam_can_skim(htsFile *fp) {
+    return hts_get_format(fp)->format == bam && fp->is_bgzf && !fp->fp.bgzf->is_be;
+}
+
+// read the 32 byte core of the next raw BAM record into x and the rest
+// into buf. returns the length of the rest, -1 at the end of the file or
+// < -1 on error.
+static int32_t skim_read(BGZF *bgzf, uint32_t x[8], kstring_t *buf) {
+    int32_t block_len, r;
+    if ((r = bgzf_read(bgzf, &block_len, 4)) != 4) return r == 0 ? -1 : -2;
+    if (block_len < 32 || bgzf_read(bgzf, x, 32) != 32) return -3;
+    block_len -= 32;
+    if (ks_resize(buf, block_len) < 0) return -4;
+    if (bgzf_read(bgzf, buf->s, block_len) != block_len) return -4;
+    return block_len;
+}
+
+// like bam_read_columns for sequential reads of BAM, but fills the columns
+// directly from the raw record instead of going through bam_read1, which
+// validates and reorganises the whole record. the variable length part is
+// read into buf and only the cigar is looked at (for rlen and qlen).
+// returns the number of rows filled or < -1 on error.
+int bam_skim_columns(htsFile *fp, bam_columns_t *cols, int n, kstring_t *buf) {
+    int32_t block_len, i = 0;
+    uint32_t x[8];
+    for (; i < n; ++i) {
+        if ((block_len = skim_read(fp->fp.bgzf, x, buf)) < 0) return block_len == -1 ? i : block_len;
+        uint32_t n_cigar = x[3] & 0xffff, l_qname = x[2] & 0xff;
+        if (cols->tid)   cols->tid[i]   = (int32_t)x[0];
+        if (cols->pos)   cols->pos[i]   = (int32_t)x[1];
+        if (cols->mapq)  cols->mapq[i]  = x[2] >> 8 & 0xff;
+        if (cols->flag)  cols->flag[i]  = x[3] >> 16;
+        if (cols->mtid)  cols->mtid[i]  = (int32_t)x[5];
+        if (cols->pnext) cols->pnext[i] = (int32_t)x[6];
+        if (cols->isize) cols->isize[i] = (int32_t)x[7];
+        if (cols->rlen || cols->qlen) {
+            if (l_qname + 4 * n_cigar > (uint32_t)block_len) return -4;
+            // the cigar is not 4-byte aligned in the raw record.
+            uint32_t op, j;
+            int32_t rlen = 0, qlen = 0;
+            for (j = 0; j < n_cigar; ++j) {
+                memcpy(&op, buf->s + l_qname + 4 * j, 4);
+                if (bam_cigar_type(bam_cigar_op(op)) & 1) qlen += bam_cigar_oplen(op);
+                if (bam_cigar_type(bam_cigar_op(op)) & 2) rlen += bam_cigar_oplen(op);
+            }
+            if (cols->rlen) cols->rlen[i] = rlen;
+            if (cols->qlen) cols->qlen[i] = qlen;
+        }
+    }
+    return i;
+}
+
+// add one alignment to the counts; same rules as samtools flagstat.
+static void flagstat_add(bam_flagstat_t *s, int flag, int tid, int mtid, int qual) {
+    int w = (flag & BAM_FQCFAIL) ? 1 : 0;
+    s->total[w]++;
+    if (flag & BAM_FSECONDARY) s->secondary[w]++;
+    else if (flag & BAM_FSUPPLEMENTARY) s->supplementary[w]++;
+    else if (flag & BAM_FPAIRED) {
+        s->paired[w]++;
+        if ((flag & BAM_FPROPER_PAIR) && !(flag & BAM_FUNMAP)) s->proper_pair[w]++;
+        if (flag & BAM_FREAD1) s->read1[w]++;
+        if (flag & BAM_FREAD2) s->read2[w]++;
+        if ((flag & BAM_FMUNMAP) && !(flag & BAM_FUNMAP)) s->singletons[w]++;
+        if (!(flag & BAM_FUNMAP) && !(flag & BAM_FMUNMAP)) {
+            s->both_mapped[w]++;
+            if (mtid != tid) {
+                s->mate_diff_chr[w]++;
+                if (qual >= 5) s->mate_diff_chr_mapq5[w]++;
+            }
+        }
+    }
+    if (!(flag & BAM_FUNMAP)) s->mapped[w]++;
+    if (flag & BAM_FDUP) s->duplicates[w]++;
+}
+
+// count the alignments in the file (itr == NULL) or a region into s.
+// whole BAM files are skimmed without decoding the records.
+// returns 0 on success or < 0 on error.
+int bam_flagstat(htsFile *fp, bam_hdr_t *h, hts_itr_t *itr, bam1_t *b, bam_flagstat_t *s) {
+    int r;
+    if (itr == NULL && bam_can_skim(fp)) {
+        kstring_t buf = {0, 0, NULL};
+        uint32_t x[8];
+        while ((r = skim_read(fp->fp.bgzf, x, &buf)) >= 0)
+            flagstat_add(s, x[3] >> 16, (int32_t)x[0], (int32_t)x[5], x[2] >> 8 & 0xff);
+        free(buf.s);
+        return r == -1 ? 0 : r;
+    }
+    while ((r = itr == NULL ? sam_read1(fp, h, b) : sam_itr_next(fp, itr, b)) >= 0) {
+        bam1_core_t *c = &b->core;
+        flagstat_add(s, c->flag, c->tid, c->mtid, c->qual);
+    }
+    return r == -1 ? 0 : r;
+}
+
+// read callback for the pileup engine; skips alignments failing the
+// mapq and flag filters so they never reach python.
+static int plp_read(void *data, bam1_t *b) {
+    plp_aux_t *aux = (plp_aux_t *)data;
+    int r;
+    while (1) {
+        r = aux->itr == NULL ? sam_read1(aux->fp, aux->h, b) : sam_itr_next(aux->fp, aux->itr, b);
+        if (r < 0) return r;
+        if (b->core.flag & aux->flag_filter) continue;
+        if (b->core.qual < aux->min_mapq) continue;
+        return r;
+    }
+}
+
+// a pileup over a single file. overlap_adjust uses htslib's detection of
+// overlapping mates which adjusts base qualities with the same algorithm
+// as tweak_overlap_quality above (the mate's base quality is set to 0).
+bam_mplp_t plp_init(plp_aux_t *aux, int overlap_adjust) {
+    void *data[1] = {aux};
+    bam_mplp_t iter = bam_mplp_init(1, plp_read, data);
+    if (overlap_adjust) bam_mplp_init_overlaps(iter);
+    bam_mplp_set_maxcnt(iter, INT_MAX);
+    return iter;
+}
+
+// number of reads in a pileup column that cover the base with at least
+// min_baseq base-quality. deletions and ref-skips are not counted.
+int plp_depth(const bam_pileup1_t *plp, int n, int min_baseq) {
+    int i, depth = 0;
+    for (i = 0; i < n; ++i) {
+        const bam_pileup1_t *p = plp + i;
+        if (p->is_del || p->is_refskip) continue;
+        if (bam_get_qual(p->b)[p->qpos] < min_baseq) continue;
+        depth++;
+    }
+    return depth;
+}
+
+// fill depth[pos - beg] for each position in [beg, end) on tid.
+// returns 0 on success or < 0 on error.
+int plp_fill_depth(bam_mplp_t iter, int tid, int beg, int end, int min_baseq, int32_t *depth) {
+    int ptid, ppos, n, r;
+    const bam_pileup1_t *plp;
+    while ((r = bam_mplp_auto(iter, &ptid, &ppos, &n, &plp)) > 0) {
+        if (ptid != tid || ppos < beg) continue;
+        if (ppos >= end) break;
+        depth[ppos - beg] = plp_depth(plp, n, min_baseq);
+    }
+    return r < 0 ? r : 0;
+}
+
+// mosdepth-style coverage of a single sequence: for each aligned block
+// (M, =, X) of each read add 1 at the start and subtract 1 at the end, then
+// take the cumulative sum. depth must be zeroed and hold tlen values.
+// returns the number of reads used or < -1 on error.
+int bam_coverage(htsFile *fp, hts_itr_t *itr, bam1_t *b, int tid, int min_mapq,
+                 int exclude_flags, int32_t *depth, int tlen) {
+    int r, k, n = 0;
+    while ((r = sam_itr_next(fp, itr, b)) >= 0) {
+        bam1_core_t *c = &b->core;
+        if (c->tid != tid || (c->flag & exclude_flags) || c->qual < min_mapq) continue;
+        uint32_t *cigar = bam_get_cigar(b);
+        int pos = c->pos;
+        for (k = 0; k < c->n_cigar; ++k) {
+            int op = bam_cigar_op(cigar[k]), len = bam_cigar_oplen(cigar[k]);
+            if (op == BAM_CMATCH || op == BAM_CEQUAL || op == BAM_CDIFF) {
+                if (pos < tlen) depth[pos]++;
+                if (pos + len < tlen) depth[pos + len]--;
+            }
+            if (bam_cigar_type(op) & 2) pos += len;
+        }
+        n++;
+    }
+    if (r < -1) return r;
+    for (k = 1; k < tlen; ++k) depth[k] += depth[k - 1];
+    return n;
+}
+
+// mean of each window of depth; out must hold ceil(n / window) values.
+void window_means(int32_t *depth, int n, int window, double *out) {
+    int i, w = 0;
+    for (i = 0; i < n; i += window, ++w) {
+        int j, end = i + window < n ? i + window : n;
+        int64_t sum = 0;
+        for (j = i; j < end; ++j) sum += depth[j];
+        out[w] = (double)sum / (end - i);
+    }
+}
+
+// next record from the file (r->itr == NULL) or from a region iterator over
+// a BCF (r->tbx == NULL) or a bgzipped VCF. returns < 0 at the end or on error.
+int vcf_next(vcf_reader_t *r, bcf1_t *b) {
+    int ret;
+    if (r->itr == NULL) return bcf_read(r->fp, r->h, b);
+    if (r->tbx == NULL) {
+        if ((ret = bcf_itr_next(r->fp, r->itr, b)) < 0) return ret;
+        // unlike bcf_read, the iterator does not drop unselected samples.
+        return bcf_subset_format(r->h, b);
+    }
+    if ((ret = tbx_itr_next(r->fp, r->tbx, r->itr, &r->s)) < 0) return ret;
+    return vcf_parse(&r->s, r->h, b) < 0 ? -2 : 0;
+}
+
+// read up to n records and fill row i of the (n x n_samples) matrices with
+// the genotype type (as from as_gts) and, if not NULL, the DP and GQ of each
+// sample; missing values are -1. non-diploid sites are set to unknown (2).
+// returns the number of rows filled or < -1 on error.
+int vcf_read_genotypes(vcf_reader_t *reader, bcf1_t *b, int n, int n_samples,
+                       int32_t *rid, int32_t *pos, int8_t *gts, int32_t *depths, float *quals) {
+    int i = 0, j, r = 0, ngt;
+    int32_t *ibuf = NULL, nibuf = 0;
+    float *fbuf = NULL;
+    int nfbuf = 0;
+    bcf_hdr_t *h = reader->h;
+    for (; i < n; ++i) {
+        if ((r = vcf_next(reader, b)) < 0) break;
+        bcf_unpack(b, BCF_UN_FMT);
+        rid[i] = b->rid;
+        pos[i] = b->pos;
+        int8_t *grow = gts + (int64_t)i * n_samples;
+        ngt = bcf_get_genotypes(h, b, &ibuf, &nibuf);
+        if (ngt == 2 * n_samples) {
+            as_gts(ibuf, n_samples);
+            for (j = 0; j < n_samples; ++j) grow[j] = ibuf[j];
+        } else {
+            for (j = 0; j < n_samples; ++j) grow[j] = 2;
+        }
+        if (depths != NULL) {
+            int32_t *drow = depths + (int64_t)i * n_samples;
+            if (bcf_get_format_int32(h, b, "DP", &ibuf, &nibuf) == n_samples) {
+                for (j = 0; j < n_samples; ++j)
+                    drow[j] = (ibuf[j] == bcf_int32_missing || ibuf[j] == bcf_int32_vector_end) ? -1 : ibuf[j];
+            } else {
+                for (j = 0; j < n_samples; ++j) drow[j] = -1;
+            }
+        }
+        if (quals != NULL) {
+            float *qrow = quals + (int64_t)i * n_samples;
+            // GQ is an Integer in the spec but some callers write a Float.
+            if (bcf_get_format_int32(h, b, "GQ", &ibuf, &nibuf) == n_samples) {
+                for (j = 0; j < n_samples; ++j)
+                    qrow[j] = (ibuf[j] == bcf_int32_missing || ibuf[j] == bcf_int32_vector_end) ? -1 : ibuf[j];
+            } else if (bcf_get_format_float(h, b, "GQ", &fbuf, &nfbuf) == n_samples) {
+                for (j = 0; j < n_samples; ++j)
+                    qrow[j] = (bcf_float_is_missing(fbuf[j]) || bcf_float_is_vector_end(fbuf[j])) ? -1 : fbuf[j];
+            } else {
+                for (j = 0; j < n_samples; ++j) qrow[j] = -1;
+            }
+        }
+    }
+    free(ibuf);
+    free(fbuf);
+    return r < -1 ? r : i;
+}
+
+// write n records, stopping at the first error.
+// returns the number of records written.
+int bam_write_many(htsFile *fp, bam_hdr_t *h, bam1_t **bs, int n) {
+    int i = 0;
+    for (; i < n; ++i)
+        if (sam_write1(fp, h, bs[i]) < 0) break;
+    return i;
+}
+
+// code of each base for FAI_ENC_UINT8: A=0, C=1, G=2, T=3, anything else 4.
+// a constant table so that concurrent fetches need no initialisation.
+static const uint8_t fai_codes[256] = {
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,0,4,1,4,4,4,2,4,4,4,4,4,4,4,4,
+    4,4,4,4,3,4,4,4,4,4,4,4,4,4,4,4,
+    4,0,4,1,4,4,4,2,4,4,4,4,4,4,4,4,
+    4,4,4,4,3,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,
+    4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4
+};
+
+// fetch the 0-based, half-open [beg, end) of chrom into out, which must hold
+// end - beg bytes (or (end - beg + 3) / 4 for FAI_ENC_2BIT). the buffer
+// allocated by faidx_fetch_seq is freed here.
+// returns the number of bases (clipped to the sequence end), -2 if chrom is
+// not in the index or -1 on error.
+int fai_fetch_into(const faidx_t *fai, const char *chrom, int beg, int end,
+                   uint8_t *out, int enc) {
+    int len, slen = faidx_seq_len(fai, chrom), i;
+    if (slen < 0) return -2;
+    if (beg < 0) beg = 0;
+    if (end > slen) end = slen;
+    if (end <= beg) return 0;
+
+    char *seq = faidx_fetch_seq(fai, chrom, beg, end - 1, &len);
+    if (seq == NULL) return len < 0 ? len : -1;
+    if (enc == FAI_ENC_NONE) {
+        memcpy(out, seq, len);
+    } else if (enc == FAI_ENC_UINT8) {
+        for (i = 0; i < len; ++i) out[i] = fai_codes[(uint8_t)seq[i]];
+    } else {
+        memset(out, 0, (len + 3) / 4);
+        for (i = 0; i < len; ++i)
+            out[i >> 2] |= (fai_codes[(uint8_t)seq[i]] & 3) << (6 - 2 * (i & 3));
+    }
+    free(seq);
+    return len;
+}
+
+// parse the token [p, q) into row i of column k.
+static void tbx_set_column(tbx_columns_t *c, int k, int i, char *p, char *q) {
+    char *e;
+    switch (c->types[k]) {
+    case 'i': {
+        long v = strtol(p, &e, 10);
+        ((int32_t *)c->data[k])[i] = e == p ? 0 : v;
+        break;
+    }
+    case 'l': {
+        long v = strtol(p, &e, 10);
+        ((long *)c->data[k])[i] = e == p ? 0 : v;
+        break;
+    }
+    case 'd': {
+        double v = strtod(p, &e);
+        ((double *)c->data[k])[i] = e == p ? NAN : v;
+        break;
+    }
+    default: // 's': values are separated by NUL.
+        kputsn(p, q - p, &c->strs[k]);
+        kputc('\0', &c->strs[k]);
+    }
+}
+
+// tokenise up to n lines from a tabix iterator into typed columns without
+// creating a python string for each line. columns missing from a line are
+// 0 for ints, NaN for floats and empty for strings.
+// returns the number of rows filled or < -1 on error.
+int tbx_read_columns(htsFile *fp, tbx_t *tbx, hts_itr_t *itr, kstring_t *s,
+                     tbx_columns_t *c, int n) {
+    int i = 0, r, k, t, seen;
+    for (; i < n; ++i) {
+        if ((r = tbx_itr_next(fp, tbx, itr, s)) < 0) return r < -1 ? r : i;
+        char *p = s->s, *end = s->s + s->l, *q;
+        for (t = 0, seen = 0; p <= end && seen < c->n_cols; ++t, p = q + 1) {
+            if ((q = memchr(p, '\t', end - p)) == NULL) q = end;
+            for (k = 0; k < c->n_cols; ++k)
+                if (c->cols[k] == t) { tbx_set_column(c, k, i, p, q); seen++; }
+        }
+        for (k = 0; seen < c->n_cols && k < c->n_cols; ++k)
+            if (c->cols[k] >= t) { tbx_set_column(c, k, i, end, end); seen++; }
+    }
+    return i;
+}
+
+// an implicit interval tree over intervals sorted by start as in cgranges
+// (https://github.com/lh3/cgranges): the sorted array is a complete binary
+// tree where node i at level k has children i -/+ 2^(k-1), and max_ends[i]
+// is the largest end in the subtree of i.
+typedef struct { int32_t start, end, id; } iv_t;
+
+static int iv_cmp(const void *a, const void *b) {
+    const iv_t *x = (const iv_t *)a, *y = (const iv_t *)b;
+    if (x->start != y->start) return x->start < y->start ? -1 : 1;
+    return x->id < y->id ? -1 : x->id > y->id;
+}
+
+// sort starts, ends and ids by start and fill max_ends.
+// returns the level of the root or -1 if n == 0 (or -2 on error).
+int iv_index(int32_t *starts, int32_t *ends, int32_t *ids, int32_t *max_ends, int n) {
+    int i, k, last_i = 0, last = 0;
+    if (n <= 0) return -1;
+    iv_t *a = malloc(n * sizeof(iv_t));
+    if (a == NULL) return -2;
+    for (i = 0; i < n; ++i) a[i].start = starts[i], a[i].end = ends[i], a[i].id = ids[i];
+    qsort(a, n, sizeof(iv_t), iv_cmp);
+    for (i = 0; i < n; ++i) starts[i] = a[i].start, ends[i] = a[i].end, ids[i] = a[i].id;
+    free(a);
+
+    for (i = 0; i < n; i += 2) last_i = i, last = max_ends[i] = ends[i];
+    for (k = 1; 1LL << k <= n; ++k) {
+        int x = 1 << (k - 1), i0 = (x << 1) - 1, step = x << 2;
+        for (i = i0; i < n; i += step) {
+            int32_t el = max_ends[i - x];
+            int32_t er = i + x < n ? max_ends[i + x] : last;
+            int32_t e = ends[i];
+            e = e > el ? e : el;
+            max_ends[i] = e > er ? e : er;
+        }
+        last_i = last_i >> k & 1 ? last_i - x : last_i + x;
+        if (last_i < n && max_ends[last_i] > last) last = max_ends[last_i];
+    }
+    return k - 1;
+}
+
+static int iv_push(iv_hits_t *hits, int32_t q, int32_t id) {
+    if (hits->n == hits->m) {
+        int64_t m = hits->m ? hits->m << 1 : 1024;
+        int32_t *query = realloc(hits->query, m * sizeof(int32_t));
+        if (query == NULL) return -1;
+        hits->query = query;
+        int32_t *ids = realloc(hits->ids, m * sizeof(int32_t));
+        if (ids == NULL) return -1;
+        hits->ids = ids, hits->m = m;
+    }
+    hits->query[hits->n] = q, hits->ids[hits->n++] = id;
+    return 0;
+}
+
+// append (query index, interval id) to hits for each interval overlapping
+// each 0-based, half-open query [qs[j], qe[j]).
+// returns 0 on success or -1 if out of memory.
+int iv_overlaps(const int32_t *starts, const int32_t *ends, const int32_t *ids,
+                const int32_t *max_ends, int n, int root_k,
+                const int32_t *qs, const int32_t *qe, int nq, iv_hits_t *hits) {
+    struct { int64_t x; int k, w; } stack[64], z;
+    int j, t;
+    if (n <= 0) return 0;
+    for (j = 0; j < nq; ++j) {
+        int32_t st = qs[j], en = qe[j];
+        t = 0;
+        stack[t].k = root_k, stack[t].x = (1LL << root_k) - 1, stack[t++].w = 0;
+        while (t) {
+            z = stack[--t];
+            if (z.k <= 3) { // small subtree: linear scan.
+                int64_t i, i0 = z.x >> z.k << z.k, i1 = i0 + (1LL << (z.k + 1)) - 1;
+                if (i1 >= n) i1 = n;
+                for (i = i0; i < i1 && starts[i] < en; ++i)
+                    if (st < ends[i] && iv_push(hits, j, ids[i]) < 0) return -1;
+            } else if (z.w == 0) { // visit the left child first.
+                int64_t y = z.x - (1LL << (z.k - 1));
+                stack[t].k = z.k, stack[t].x = z.x, stack[t++].w = 1;
+                if (y >= n || max_ends[y] > st)
+                    stack[t].k = z.k - 1, stack[t].x = y, stack[t++].w = 0;
+            } else if (z.x < n && starts[z.x] < en) {
+                if (st < ends[z.x] && iv_push(hits, j, ids[z.x]) < 0) return -1;
+                stack[t].k = z.k - 1, stack[t].x = z.x + (1LL << (z.k - 1)), stack[t++].w = 0;
+            }
+        }
+    }
+    return 0;
+}
+
+// set the size of the cache of decompressed blocks. returns 1 if htslib
+// caches blocks (it is only built in with -DBGZF_CACHE), 0 if it does not
+// and -1 if fp is not BGZF compressed.
+int hts_set_block_cache(htsFile *fp, int size) {
+    if (!fp->is_bgzf) return -1;
+    bgzf_set_cache_size(fp->fp.bgzf, size);
+    return fp->fp.bgzf->cache_size == size;
+}
+
+// the BGZF block addresses at the start and end of each chunk of a region
+// query. writes at most n of them and returns the number there are, so a
+// result > n means blocks was too small.
+int hts_itr_blocks(const hts_itr_t *itr, int64_t *blocks, int n) {
+    int i, k = 0;
+    if (itr->off == NULL) return 0;
+    for (i = 0; i < itr->n_off; ++i) {
+        if (k < n) blocks[k] = itr->off[i].u >> 16;
+        k++;
+        if (itr->off[i].v >> 16 != itr->off[i].u >> 16) {
+            if (k < n) blocks[k] = itr->off[i].v >> 16;
+            k++;
+        }
+    }
+    return k;
+}
+
+// read up to n alignments of a region query into bs. an iterator is not
+// tied to one handle: if fp was used by another query since this iterator
+// was last advanced, fp is first moved back to where the iterator stopped.
+// returns the number read, or < -1 on error.
+int bam_itr_read_batch(htsFile *fp, bam_hdr_t *h, hts_itr_t *itr, bam1_t **bs, int n) {
+    int i = 0, r;
+    if (!fp->is_bgzf) return -3;
+    if (itr->curr_off != 0 && !itr->finished && bgzf_tell(fp->fp.bgzf) != (int64_t)itr->curr_off)
+        if (bgzf_seek(fp->fp.bgzf, itr->curr_off, SEEK_SET) < 0) return -2;
+    for (; i < n; ++i)
+        if ((r = sam_itr_next(fp, itr, bs[i])) < 0) return r < -1 ? r : i;
+    return i;
+}
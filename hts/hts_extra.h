@@ -1,5 +1,7 @@
 int bam_get_read_seq(bam1_t *b, kstring_t * str);
 
+int bam_decode_seq(bam1_t *b, char *out);
+
 void tweak_overlap_quality(bam1_t *, bam1_t *);
 
 int as_gts(int *gts, int num_samples);
@@ -9,3 +11,97 @@ int aux_type2size(uint8_t type);
 
 int skip_aux(uint8_t *s);
 
+
+typedef struct {
+    int32_t *tid, *pos, *rlen, *qlen, *isize, *mtid, *pnext;
+    uint8_t *mapq;
+    uint16_t *flag;
+    // aux tags; see bam_fill_tags
+    int n_tags;
+    const char *tags;     // n_tags 2-character tag names, concatenated
+    char *tag_types;
+    double **tag_nums;
+    kstring_t *tag_strs;
+} bam_columns_t;
+
+int bam_read_columns(htsFile *fp, bam_hdr_t *h, hts_itr_t *itr, bam1_t *b,
+                     bam_columns_t *cols, int n);
+int bam_can_skim(htsFile *fp);
+
+// flagstat counts; index 0 is qc-passed, 1 is qc-failed.
+typedef struct {
+    int64_t total[2], mapped[2], paired[2], proper_pair[2], both_mapped[2];
+    int64_t singletons[2], read1[2], read2[2], duplicates[2];
+    int64_t mate_diff_chr[2], mate_diff_chr_mapq5[2];
+    int64_t secondary[2], supplementary[2];
+} bam_flagstat_t;
+
+int bam_flagstat(htsFile *fp, bam_hdr_t *h, hts_itr_t *itr, bam1_t *b, bam_flagstat_t *s);
+int bam_skim_columns(htsFile *fp, bam_columns_t *cols, int n, kstring_t *buf);
+
+typedef struct {
+    htsFile *fp;
+    bam_hdr_t *h;
+    hts_itr_t *itr;
+    int min_mapq;
+    int flag_filter;
+} plp_aux_t;
+
+bam_mplp_t plp_init(plp_aux_t *aux, int overlap_adjust);
+int plp_depth(const bam_pileup1_t *plp, int n, int min_baseq);
+int plp_fill_depth(bam_mplp_t iter, int tid, int beg, int end, int min_baseq, int32_t *depth);
+
+int bam_coverage(htsFile *fp, hts_itr_t *itr, bam1_t *b, int tid, int min_mapq,
+                 int exclude_flags, int32_t *depth, int tlen);
+void window_means(int32_t *depth, int n, int window, double *out);
+
+typedef struct {
+    htsFile *fp;
+    bcf_hdr_t *h;
+    hts_itr_t *itr;  // NULL to read sequentially
+    tbx_t *tbx;      // set when itr is over a bgzipped VCF
+    kstring_t s;
+} vcf_reader_t;
+
+int vcf_next(vcf_reader_t *r, bcf1_t *b);
+
+int vcf_read_genotypes(vcf_reader_t *reader, bcf1_t *b, int n, int n_samples,
+                       int32_t *rid, int32_t *pos, int8_t *gts, int32_t *depths, float *quals);
+
+int bam_write_many(htsFile *fp, bam_hdr_t *h, bam1_t **bs, int n);
+
+static const int FAI_ENC_NONE = 0;
+static const int FAI_ENC_UINT8 = 1;
+static const int FAI_ENC_2BIT = 2;
+
+int fai_fetch_into(const faidx_t *fai, const char *chrom, int beg, int end,
+                   uint8_t *out, int enc);
+
+// typed columns for tbx_read_columns. types are 'i' (int32), 'l' (long),
+// 'd' (double) or 's' (string, appended to strs[k]).
+typedef struct {
+    int n_cols;
+    int *cols;
+    char *types;
+    void **data;
+    kstring_t *strs;
+} tbx_columns_t;
+
+int tbx_read_columns(htsFile *fp, tbx_t *tbx, hts_itr_t *itr, kstring_t *s,
+                     tbx_columns_t *c, int n);
+
+// (query index, interval id) pairs from iv_overlaps. free query and ids.
+typedef struct {
+    int64_t n, m;
+    int32_t *query, *ids;
+} iv_hits_t;
+
+int iv_index(int32_t *starts, int32_t *ends, int32_t *ids, int32_t *max_ends, int n);
+int iv_overlaps(const int32_t *starts, const int32_t *ends, const int32_t *ids,
+                const int32_t *max_ends, int n, int root_k,
+                const int32_t *qs, const int32_t *qe, int nq, iv_hits_t *hits);
+
+int hts_set_block_cache(htsFile *fp, int size);
+int hts_itr_blocks(const hts_itr_t *itr, int64_t *blocks, int n);
+
+int bam_itr_read_batch(htsFile *fp, bam_hdr_t *h, hts_itr_t *itr, bam1_t **bs, int n);
@@ -8,6 +8,10 @@ def _raise_if_null(v, msg):
     if v == ffi.NULL:
         raise Exception(msg)
 
+def _cstr(s):
+    """Encode a str for a char * argument; cffi only takes bytes on python 3."""
+    return s if isinstance(s, bytes) else s.encode()
+
 ffi = FFI()
 
 HERE = op.relpath(op.dirname(__file__))
@@ -28,6 +32,7 @@ libhts = ffi.verify('''
 #include "htslib/faidx.h"
 #include "htslib/vcf.h"
 #include "htslib/kfunc.h"
+#include "htslib/thread_pool.h"
 #include "hts_extra.h"
 ''',
     libraries=['c', 'z', 'hts'],
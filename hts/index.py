@@ -0,0 +1,124 @@
+from .htsffi import libhts, ffi, _raise_if_null, _cstr
+import os
+import os.path as op
+import threading
+
+# HTS_FMT_BAI in htslib/hts.h; hts_idx_load also finds a .csi.
+HTS_FMT_BAI = 1
+
+
+class _Index(object):
+
+    # path => (mtimes, index) for `cached`; shared by the whole process.
+    _lock = threading.Lock()
+
+    @classmethod
+    def _index_paths(cls, fname):
+        """The index files that htslib may load for `fname`."""
+        raise NotImplementedError
+
+    @classmethod
+    def _mtimes(cls, fname):
+        mtimes = [os.stat(fname).st_mtime]
+        for path in cls._index_paths(fname):
+            mtimes.append(os.stat(path).st_mtime if op.exists(path) else None)
+        return tuple(mtimes)
+
+    @classmethod
+    def cached(cls, fname):
+        """Return the index of `fname` from the process-wide cache, loading it
+        if it is not there or if the file or its index changed since."""
+        key = op.abspath(fname)
+        mtimes = cls._mtimes(fname)
+        with cls._lock:
+            hit = cls._cache.get(key)
+            if hit is not None and hit[0] == mtimes:
+                return hit[1]
+        idx = cls(fname)
+        with cls._lock:
+            cls._cache[key] = (mtimes, idx)
+        return idx
+
+    @classmethod
+    def evict(cls, fname):
+        """Drop the cached index of `fname`, e.g. after rebuilding it."""
+        with cls._lock:
+            cls._cache.pop(op.abspath(fname), None)
+
+    @classmethod
+    def clear_cache(cls):
+        with cls._lock:
+            cls._cache.clear()
+
+    def __repr__(self):
+        return "%s('%s')" % (self.__class__.__name__, self.fn)
+
+
+class BamIndex(_Index):
+
+    """
+    A loaded .bai/.csi index that many `Bam` handles of the same file can
+    share, so it is read from disk once.
+
+    Use `BamIndex.cached(fname)` to share indexes across a process; an
+    index is reloaded if the BAM or its index file is modified.
+
+    Examples
+    --------
+
+    >>> import os.path as op
+    >>> from hts import Bam
+    >>> fn = "%s/test/small.bam" % op.dirname(__file__)
+    >>> idx = BamIndex.cached(fn)
+    >>> idx is BamIndex.cached(fn)
+    True
+    >>> bams = [Bam(fn, index=idx) for _ in range(3)]
+    >>> [len(list(b('chr2L:9000-11000'))) for b in bams]
+    [10, 10, 10]
+    """
+
+    _cache = {}
+
+    @classmethod
+    def _index_paths(cls, fname):
+        return [fname + ".bai", op.splitext(fname)[0] + ".bai", fname + ".csi"]
+
+    def __init__(self, fname):
+        if fname.endswith(".cram"):
+            # htslib ties CRAM indexes to a single open file.
+            raise ValueError("BamIndex: CRAM indexes can not be shared: %s" % fname)
+        self.fn = fname
+        idx = libhts.hts_idx_load(_cstr(fname), HTS_FMT_BAI)
+        _raise_if_null(idx, "BamIndex: unable to load index for %s" % fname)
+        self._idx = ffi.gc(idx, libhts.hts_idx_destroy)
+
+
+class TbxIndex(_Index):
+
+    """
+    A loaded tabix index that many `Tbx` handles of the same file can share.
+
+    Examples
+    --------
+
+    >>> import os.path as op
+    >>> from hts import Tbx
+    >>> fn = '%s/test/example.gtf.gz' % op.dirname(__file__)
+    >>> idx = TbxIndex.cached(fn)
+    >>> idx #doctest: +ELLIPSIS
+    TbxIndex('...example.gtf.gz')
+    >>> len(list(Tbx(fn, index=idx)('chr1:1-1800')))
+    4
+    """
+
+    _cache = {}
+
+    @classmethod
+    def _index_paths(cls, fname):
+        return [fname + ".tbi", fname + ".csi"]
+
+    def __init__(self, fname):
+        self.fn = fname
+        tbx = libhts.tbx_index_load(fname)
+        _raise_if_null(tbx, "TbxIndex: unable to load index for %s" % fname)
+        self._tbx = ffi.gc(tbx, libhts.tbx_destroy)
@@ -0,0 +1,122 @@
+from __future__ import print_function
+import gzip
+import multiprocessing
+from .bam import Bam
+from .tbx import Tbx
+
+# the Bam for the current worker process; opened once by _init_worker so
+# that the file and its index are not reloaded for every shard.
+_bam = None
+
+
+def _init_worker(bam_path):
+    global _bam
+    _bam = Bam(bam_path)
+
+
+def _run_shard(args):
+    func, (chrom, start, end) = args
+    return func(_bam, chrom, start, end)
+
+
+def shards(header, chunk_size):
+    """Split every target in a `BamHeader` into (chrom, start, end) chunks.
+
+    >>> import os.path as op
+    >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__))
+    >>> list(shards(bam.header, 10000000))[:3]
+    [('chr2L', 0, 10000000), ('chr2L', 10000000, 20000000), ('chr2L', 20000000, 23011544)]
+    """
+    for chrom, length in zip(header.seqs, header.lengths):
+        for start in range(0, length, chunk_size):
+            yield chrom, start, min(start + chunk_size, length)
+
+
+def read_regions(fname):
+    """Read (chrom, start, end) tuples from a BED file.
+
+    bgzipped files are read through `Tbx` in the order of the index.
+    """
+    if fname.endswith(".gz"):
+        tbx = Tbx(fname)
+        for chrom in tbx.sequences:
+            for toks in tbx(str(chrom)):
+                yield toks[0], toks[1], toks[2]
+        return
+
+    with open(fname) as fh:
+        for line in fh:
+            if line.startswith(("#", "track", "browser")) or not line.strip():
+                continue
+            toks = line.split("\t")
+            yield toks[0], int(toks[1]), int(toks[2])
+
+
+def map_regions(bam_path, func, regions=None, chunk_size=10000000, processes=None):
+    """Apply `func` to shards of an indexed BAM in parallel.
+
+    Parameters
+    ----------
+
+    bam_path : str
+        path to an indexed bam.
+
+    func : callable
+        called as `func(bam, chrom, start, end)` for each shard with a `Bam`
+        opened once per worker and 0-based, half-open coordinates. It must
+        be picklable (defined at module level) when processes != 1.
+        Alignments that span a shard boundary are returned by a region query
+        on both shards so per-read statistics should only count reads with
+        `start <= aln.pos < end`.
+
+    regions : list of (chrom, start, end) or str, optional
+        shards to process or the path to a BED file. By default, each
+        target in the header is split into chunks of `chunk_size`.
+
+    chunk_size : int
+        size of shards generated from the header.
+
+    processes : int, optional
+        number of worker processes; defaults to the number of CPUs.
+        If 1, shards are processed in the current process.
+
+    Returns
+    -------
+    generator of ((chrom, start, end), result) in the order of the shards.
+
+    Examples
+    --------
+
+    >>> import os.path as op
+    >>> def count(bam, chrom, start, end):
+    ...     return sum(start <= a.pos < end for a in bam("%s:%d-%d" % (chrom, start + 1, end)))
+    >>> bam_path = "%s/test/small.bam" % op.dirname(__file__)
+    >>> res = list(map_regions(bam_path, count, regions=[('chr2L', 9000, 11000)], processes=1))
+    >>> res[0][0]
+    ('chr2L', 9000, 11000)
+    >>> res[0][1] == sum(9000 <= a.pos < 11000 for a in Bam(bam_path)('chr2L:9001-11000'))
+    True
+    """
+    if regions is None:
+        regions = list(shards(Bam(bam_path).header, chunk_size))
+    elif isinstance(regions, str):
+        regions = list(read_regions(regions))
+    else:
+        regions = list(regions)
+
+    if processes == 1:
+        _init_worker(bam_path)
+        for region in regions:
+            yield region, _run_shard((func, region))
+        return
+
+    pool = multiprocessing.Pool(processes, _init_worker, (bam_path,))
+    try:
+        # imap returns results in the order of the shards.
+        results = pool.imap(_run_shard, [(func, r) for r in regions])
+        for i, res in enumerate(results):
+            yield regions[i], res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,5 +1,9 @@
 import os.path as op
 from .htsffi import libhts, ffi, _raise_if_null
+from .threads import set_threads
+from .cache import set_cache
+from .index import TbxIndex
+import array
 import atexit
 
 class Tbx(object):
@@ -16,11 +20,12 @@ class Tbx(object):
     ['chr1', 'ENSEMBL', 'transcript', 1737, 4275]
     ['chr1', 'HAVANA', 'gene', 1737, 4275]
     """
-    def __init__(self, fname):
+    def __init__(self, fname, threads=None, cache_size=None, index=None):
         assert op.exists(fname), ("Tbx: no file", fname)
-        if not op.exists("%s.tbi" % fname):
+        self.fn = fname
+        if index in (None, True) and not op.exists("%s.tbi" % fname):
             if fname.endswith('.bed.gz'):
-                Tbx.build(fname)
+                Tbx.build(fname, preset=TBX_UCSC)
             elif fname.endswith(('.gff.gz', '.gtf.gz')):
                 Tbx.build(fname, 1, 4, 5, '#', 0)
             elif fname.endswith(('.vcf.gz')):
@@ -28,25 +33,35 @@ class Tbx(object):
             else:
                 raise Exception('%s.tbi not found and filetype not known' % fname)
 
-        tbx = self._tbx = libhts.tbx_index_load(fname);
-        _raise_if_null(tbx, "Tbx:unable to find %s.tbi" % fname)
+        if index is True:
+            index = TbxIndex.cached(fname)
+        if index is not None:
+            # shared with other handles; kept alive by self._index.
+            self._index = index
+            tbx = self._tbx = index._tbx
+        else:
+            tbx = self._tbx = libhts.tbx_index_load(fname);
+            _raise_if_null(tbx, "Tbx:unable to find %s.tbi" % fname)
+            atexit.register(libhts.tbx_destroy, tbx)
 
         htf = self._htf = libhts.hts_open(fname, "r");
-        _raise_if_null(tbx, "Tbx:unable to find %s" % fname)
+        _raise_if_null(htf, "Tbx:unable to find %s" % fname)
+        self._pool = set_threads(htf, threads)
+        self.cache_estimate = set_cache(htf, cache_size)
 
         atexit.register(libhts.hts_close, htf)
-        atexit.register(libhts.tbx_destroy, tbx)
 
     @classmethod
     def build(cls, fname, seq_col=1, start_col=2, end_col=3, comment="#",
-                 line_skip=0):
+                 line_skip=0, preset=0):
         """
-        1-based columns
+        1-based columns. Use preset=TBX_UCSC for files with 0-based,
+        half-open coordinates such as BED.
         """
         conf = ffi.new('tbx_conf_t *')
         conf.sc, conf.bc, conf.ec = seq_col, start_col, end_col
         conf.meta_char = ffi.cast('char', comment)
-        conf.preset = 0
+        conf.preset = preset
         conf.line_skip = line_skip
         assert libhts.tbx_index_build(fname, -1, conf) != -1
         return Tbx(fname)
@@ -63,8 +78,26 @@ class Tbx(object):
             libhts.free(cnames)
 
     def __call__(self, region):
-        itr = libhts.tbx_itr_querys(self._tbx, region)
         s = ffi.new("kstring_t *")
+        try:
+            for toks in self._rows(region, s):
+                yield toks
+        finally:
+            libhts.free(s.s)
+
+    query = __call__
+
+    def _itr_querys(self, region):
+        itr = libhts.tbx_itr_querys(self._tbx, region)
+        if self.cache_estimate is not None:
+            self.cache_estimate.record(itr)
+        return itr
+
+    def _rows(self, region, s):
+        """Generate the split lines in region using the kstring s."""
+        itr = self._itr_querys(region)
+        if itr == ffi.NULL:
+            return
         conf = self._tbx.conf
 
         # get 0-based cols so we can convert to ints
@@ -82,9 +115,249 @@ class Tbx(object):
                 yield toks
 
                 slen = libhts.tbx_itr_next(self._htf, self._tbx, itr, s)
+        finally:
+            libhts.hts_itr_destroy(itr)
+
+    def query_columns(self, region, columns=None, dtypes=None, batch_size=16384):
+        """
+        Query a region and return typed columns instead of split lines.
+
+        Lines are tokenised in C. Numeric columns are array.array (which
+        numpy.frombuffer can wrap without a copy) and string columns lists.
+
+        Parameters
+        ----------
+        region : str
+
+        columns : list of int, optional
+            0-based columns to extract. Default is the sequence, start and
+            end columns of the index.
+
+        dtypes : list of str, optional
+            type of each column: 'i' (int32), 'l' (long), 'd' (float) or 's'
+            (str). Default is 's' for each column, or ('s', 'i', 'i') for the
+            default columns. Values that do not parse are 0 (or NaN for 'd').
+
+        Returns
+        -------
+        list with one column per entry in `columns`.
+
+        >>> tbx = Tbx('%s/test/example.gtf.gz' % op.dirname(__file__))
+        >>> chroms, starts, ends = tbx.query_columns('chr1:1-1800')
+        >>> starts
+        array('i', [1737, 1737, 1737, 1737])
+        >>> features, scores = tbx.query_columns('chr1:1-1800', [2, 5], ['s', 'd'])
+        >>> features
+        ['UTR', 'exon', 'transcript', 'gene']
+        """
+        s = ffi.new("kstring_t *")
+        try:
+            return self._query_columns(region, columns, dtypes, s, batch_size)
+        finally:
+            libhts.free(s.s)
+
+    def query_many(self, regions, columns=None, dtypes=None):
+        """
+        Query each region in turn, sharing one line buffer between queries.
+
+        Generates (region, result) where result is the list of split lines
+        (as from `__call__`) or, if `columns` or `dtypes` is given, the
+        columns from `query_columns`.
+
+        >>> tbx = Tbx('%s/test/example.gtf.gz' % op.dirname(__file__))
+        >>> [(region, len(rows)) for region, rows in tbx.query_many(['chr1:1-1800', 'chr1:1-1'])]
+        [('chr1:1-1800', 4), ('chr1:1-1', 0)]
+        """
+        s = ffi.new("kstring_t *")
+        try:
+            for region in regions:
+                if columns is None and dtypes is None:
+                    yield region, list(self._rows(region, s))
+                else:
+                    yield region, self._query_columns(region, columns, dtypes, s)
         finally:
             libhts.free(s.s)
+
+    def _query_columns(self, region, columns, dtypes, s, batch_size=16384):
+        if columns is None:
+            conf = self._tbx.conf
+            columns = [conf.sc - 1, conf.bc - 1]
+            if conf.ec > 0:
+                columns.append(conf.ec - 1)
+            if dtypes is None:
+                dtypes = ['s'] + ['i'] * (len(columns) - 1)
+        elif dtypes is None:
+            dtypes = ['s'] * len(columns)
+        assert len(columns) == len(dtypes), ("Tbx: need a dtype per column", columns, dtypes)
+        assert all(t in "ilds" for t in dtypes), ("Tbx: bad dtypes", dtypes)
+
+        out = [[] if t == 's' else array.array(_array_types[t]) for t in dtypes]
+        itr = self._itr_querys(region)
+        if itr == ffi.NULL:
+            return out
+
+        bufs = [None if t == 's' else array.array(_array_types[t], [0]) * batch_size
+                for t in dtypes]
+        c = ffi.new("tbx_columns_t *")
+        ccols = ffi.new("int[]", columns)
+        ctypes = ffi.new("char[]", "".join(dtypes))
+        cdata = ffi.new("void *[]", [ffi.NULL if b is None else ffi.from_buffer(b)
+                                     for b in bufs])
+        cstrs = ffi.new("kstring_t[]", len(columns))
+        c.n_cols, c.cols, c.types, c.data, c.strs = len(columns), ccols, ctypes, cdata, cstrs
+        try:
+            while True:
+                n = libhts.tbx_read_columns(self._htf, self._tbx, itr, s, c, batch_size)
+                if n < 0:
+                    raise Exception("Tbx: error reading %s" % region)
+                for k, buf in enumerate(bufs):
+                    if buf is None:
+                        vals = ffi.buffer(cstrs[k].s, cstrs[k].l)[:].split(b'\0')
+                        out[k].extend(vals[:n])
+                        cstrs[k].l = 0
+                    else:
+                        out[k].extend(buf[:n] if n < batch_size else buf)
+                if n < batch_size:
+                    break
+        finally:
+            for k in range(len(columns)):
+                libhts.free(cstrs[k].s)
             libhts.hts_itr_destroy(itr)
+        return out
+
+    def load_intervals(self, chrom=None, columns=None, dtypes=None):
+        """
+        Read all intervals of `chrom` (or of every sequence) into an
+        in-memory `Intervals` index so that repeated overlap queries do not
+        seek and decompress the file.
+
+        Parameters
+        ----------
+        chrom : str, optional
+
+        columns, dtypes : list, optional
+            extra columns to keep for each interval, as in `query_columns`.
+
+        >>> tbx = Tbx('%s/test/example.gtf.gz' % op.dirname(__file__))
+        >>> iv = tbx.load_intervals('chr1')
+        >>> len(iv), iv.starts[0], iv.ends[0]
+        (218, 1736, 2090)
+        """
+        conf = self._tbx.conf
+        cols = [conf.bc - 1, conf.ec - 1 if conf.ec > 0 else 3]
+        types = ['i', 'i' if conf.ec > 0 else 's']
+        columns, dtypes = list(columns or []), list(dtypes or ['s'] * len(columns or []))
+        assert len(columns) == len(dtypes), ("Tbx: need a dtype per column", columns, dtypes)
+
+        # tabix files are 1-based with inclusive ends unless they are BED;
+        # older .bed.gz indexes were built without the UCSC flag.
+        zero_based = conf.preset & TBX_UCSC or self.fn.endswith('.bed.gz')
+        offset = 0 if zero_based else 1
+        chroms, starts, ends = [], array.array('i'), array.array('i')
+        extra = [[] if t == 's' else array.array(_array_types[t]) for t in dtypes]
+        s = ffi.new("kstring_t *")
+        try:
+            for c in ([chrom] if chrom is not None else map(str, self.sequences)):
+                res = self._query_columns(c, cols + columns, types + dtypes, s)
+                n = len(res[0])
+                chroms.append((c, len(starts), n))
+                st = array.array('i', [v - offset for v in res[0]])
+                starts.extend(st)
+                if conf.ec > 0:
+                    ends.extend(res[1])
+                else: # vcf: the end is from the length of the REF.
+                    ends.extend(array.array('i', [b + len(ref) for b, ref in zip(st, res[1])]))
+                for k, col in enumerate(res[2:]):
+                    extra[k].extend(col)
+        finally:
+            libhts.free(s.s)
+        return Intervals(chroms, starts, ends, extra)
+
+# array.array typecodes for the dtypes of query_columns.
+_array_types = {'i': 'i', 'l': 'l', 'd': 'd'}
+
+TBX_UCSC = 0x10000
+
+
+class Intervals(object):
+    """
+    In-memory intervals with an implicit interval tree (as in cgranges) per
+    sequence for fast, vectorised overlap queries. Create with
+    `Tbx.load_intervals`.
+
+    `starts` and `ends` (0-based, half-open) and the extra `columns` are in
+    file order and indexed by the interval ids returned from `overlaps`.
+
+    >>> tbx = Tbx('%s/test/example.gtf.gz' % op.dirname(__file__))
+    >>> iv = tbx.load_intervals(columns=[2], dtypes=['s'])
+    >>> q, ids = iv.overlaps([1736, 0], [1737, 10], chrom='chr1')
+    >>> list(q), [iv.columns[0][i] for i in ids]
+    ([0, 0, 0, 0], ['UTR', 'exon', 'transcript', 'gene'])
+    """
+
+    def __init__(self, chroms, starts, ends, columns=()):
+        self.starts, self.ends, self.columns = starts, ends, list(columns)
+        self.chroms = [c for c, _, _ in chroms]
+        self._trees = {}
+        for chrom, off, n in chroms:
+            st, en = starts[off:off + n], ends[off:off + n]
+            ids = array.array('i', range(off, off + n))
+            max_ends = array.array('i', [0]) * n
+            k = libhts.iv_index(_ptr(st), _ptr(en), _ptr(ids), _ptr(max_ends), n)
+            if k < -1:
+                raise MemoryError("Intervals: unable to index %s" % chrom)
+            self._trees[chrom] = (st, en, ids, max_ends, k)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlaps(self, starts, ends, chrom=None):
+        """
+        Find the intervals overlapping each query [starts[i], ends[i]).
+
+        Parameters
+        ----------
+        starts, ends : sequences of int
+            0-based, half-open query coordinates.
+
+        chrom : str
+            sequence of the queries; optional if only one was loaded.
+
+        Returns
+        -------
+        (query_index, interval_id) as two array.array('i') of equal length.
+        """
+        if chrom is None:
+            assert len(self._trees) == 1, ("Intervals: chrom is required", self.chroms)
+            chrom = self.chroms[0]
+        qs, qe = _int_array(starts), _int_array(ends)
+        assert len(qs) == len(qe), ("Intervals: starts and ends differ in length")
+        query, ids = array.array('i'), array.array('i')
+        if chrom not in self._trees or len(qs) == 0:
+            return query, ids
+
+        st, en, tids, max_ends, k = self._trees[chrom]
+        hits = ffi.new("iv_hits_t *")
+        try:
+            if libhts.iv_overlaps(_ptr(st), _ptr(en), _ptr(tids), _ptr(max_ends), len(st), k,
+                                  _ptr(qs), _ptr(qe), len(qs), hits) < 0:
+                raise MemoryError("Intervals: out of memory")
+            n = hits.n
+            query, ids = array.array('i', [0]) * n, array.array('i', [0]) * n
+            if n:
+                ffi.memmove(ffi.from_buffer(query), hits.query, 4 * n)
+                ffi.memmove(ffi.from_buffer(ids), hits.ids, 4 * n)
+        finally:
+            libhts.free(hits.query)
+            libhts.free(hits.ids)
+        return query, ids
+
+
+def _ptr(arr):
+    return ffi.cast("int32_t *", ffi.from_buffer(arr))
 
-    query = __call__
 
+def _int_array(vals):
+    if isinstance(vals, array.array) and vals.typecode == 'i':
+        return vals
+    return array.array('i', vals)
@@ -0,0 +1,43 @@
+"""
+asyncio tests of hts.aio; python 3 only. nose skips files starting with "_",
+so run these with `python3 -m pytest hts/test/_test_aio.py`.
+"""
+import asyncio
+import os
+from hts.aio import AsyncBam
+
+HERE = os.path.dirname(__file__)
+BAM = os.path.join(HERE, "small.bam")
+REGIONS = ['chr2L:1-23011544', 'chr2L:9000-11000', 'chr2L:9000-9500', 'chr2L:1-10']
+
+
+def _key(a):
+    return a.pos, a.qname, a.flag
+
+
+async def _collect(q):
+    return [_key(a) async for a in q]
+
+
+def test_async_for():
+    ab = AsyncBam(BAM, max_workers=2, batch_size=3)
+    try:
+        expected = [[_key(a) for a in ab.query(r)] for r in REGIONS]
+        assert len(expected[1]) == 10 and expected[3] == []
+
+        async def main():
+            # many tasks iterate at once over the 2 handles.
+            return await asyncio.gather(*[_collect(ab.query(r)) for r in REGIONS * 8])
+        assert asyncio.run(main()) == expected * 8
+        assert len(ab._all) == 2 and ab._handles.qsize() == 2
+    finally:
+        ab.close()
+    assert ab._handles.qsize() == 0
+
+
+def test_async_for_shared_index():
+    ab = AsyncBam(BAM, max_workers=1, index=True)
+    try:
+        assert len(asyncio.run(_collect(ab.query('chr2L:9000-11000')))) == 10
+    finally:
+        ab.close()
@@ -1,5 +1,6 @@
 import os
-from hts import Bam
+from hts import Bam, ThreadPool
+from hts.bam import Alignment
 
 HERE = os.path.dirname(__file__)
 
@@ -27,3 +28,434 @@ def test_aux_bam():
     assert aln.tags == [('MC', 'Z', '101M'), ('MD', 'Z', '16T2C80'), ('PG', 'Z', 'bwa-meth'), ('RG', 'Z', '44_Mm08_WEAd_Db2_WGBS_E_1_L001__trimmed'), ('NM', 'C', 28), ('MQ', 'C', 60), ('UQ', 'S', 1064), ('AS', 'C', 87), ('XS', 'C', 101)], aln.tags
     aln = next(bam)
     assert aln.tags == [('MC', 'Z', '7M1D94M'), ('MD', 'Z', '9T2C87'), ('PG', 'Z', 'bwa-meth'), ('RG', 'Z', '44_Mm08_WEAd_Db2_WGBS_E_1_L001__trimmed'), ('NM', 'C', 27), ('MQ', 'C', 25), ('UQ', 'S', 981), ('AS', 'C', 87), ('XS', 'C', 101)]
+
+def test_read_batch_matches_iteration():
+    alns = [(a.flag, a.pos, a.mapq, a.isize) for a in Bam(AUX_SAM)]
+
+    bam = Bam(AUX_SAM)
+    cols = {"flag": [], "pos": [], "mapq": [], "isize": []}
+    for batch in bam.batches(n=3, fields=("flag", "pos", "mapq", "isize")):
+        assert len(batch["pos"]) <= 3
+        for k in cols:
+            cols[k].extend(batch[k])
+
+    assert alns == list(zip(cols["flag"], cols["pos"], cols["mapq"], cols["isize"]))
+
+def test_shared_thread_pool():
+    import tempfile
+    pool = ThreadPool(2)
+    src = Bam(AUX_SAM, threads=pool)
+    alns = [a.copy() for a in src]
+
+    tmp = tempfile.mktemp(suffix=".bam")
+    out = Bam(tmp, "wb", header=src.header, threads=pool)
+    out.write(*alns)
+    out.close()
+
+    got = [str(a) for a in Bam(tmp, threads=2)]
+    assert got == [str(a) for a in alns]
+    for f in (tmp, tmp + ".bai"):
+        if os.path.exists(f):
+            os.unlink(f)
+
+
+def _count_starts(bam, chrom, start, end):
+    region = "%s:%d-%d" % (chrom, start + 1, end)
+    return sum(start <= a.pos < end for a in bam(region))
+
+def test_map_regions():
+    from hts.parallel import map_regions
+    bam = os.path.join(HERE, "small.bam")
+    res = list(map_regions(bam, _count_starts, chunk_size=5000000, processes=2))
+    chroms = [r[0][0] for r in res]
+    assert chroms == sorted(chroms, key=list(Bam(bam).header.seqs).index)
+    assert sum(r[1] for r in res) == sum(a.rname is not None for a in Bam(bam)), res
+
+def test_map_regions_bed():
+    import shutil
+    import tempfile
+    from hts.parallel import map_regions
+    bam = os.path.join(HERE, "small.bam")
+    bed = os.path.join(HERE, "small.bed")
+    tmp = tempfile.mkdtemp()
+    bgz = os.path.join(tmp, "small.bed.gz")
+    shutil.copy(os.path.join(HERE, "small.bed.gz"), bgz)
+    regions = [('chr2L', 0, 9000), ('chr2L', 9000, 11000),
+               ('chr2L', 11000, 5000000), ('chr2L', 5000000, 23011544)]
+    try:
+        for path in (bed, bgz):
+            res = list(map_regions(bam, _count_starts, regions=path, processes=1))
+            assert [r for r, _ in res] == regions, (path, res)
+            assert [n for _, n in res] == [_count_starts(Bam(bam), *r) for r in regions]
+            assert sum(n for _, n in res) == sum(a.rname == 'chr2L' for a in Bam(bam))
+    finally:
+        shutil.rmtree(tmp)
+
+def test_get_tag():
+    from nose.tools import assert_raises
+    aln = next(Bam(AUX_SAM))
+    assert aln.get_tag("NM") == 28
+    assert aln.get_tag("MD") == "16T2C80"
+    for key, _, val in aln.tags:
+        assert aln.get_tag(key) == val
+    assert_raises(KeyError, aln.get_tag, "ZZ")
+
+    s = str(aln) + "\tZB:B:s,-1,2,300\tZA:A:x\tZF:f:0.5"
+    b = Alignment.from_sam_str(s, aln._h)
+    assert list(b.get_tag("ZB")) == [-1, 2, 300]
+    assert b.get_tag("ZA") == "x"
+    assert b.get_tag("ZF") == 0.5
+    assert b.tags[-3][:2] == ("ZB", "B")
+
+def test_batch_tags():
+    exp_nm, exp_rg = zip(*[(a.get_tag("NM"), a.get_tag("RG")) for a in Bam(AUX_SAM)])
+
+    cols = Bam(AUX_SAM, tags=["NM", "RG", "XX"]).read_batch(100, fields=("pos",))
+    assert list(cols["NM"]) == list(exp_nm)
+    assert cols["RG"] == list(exp_rg)
+    assert all(v != v for v in cols["XX"])  # NaN when missing
+
+def test_batch_tag_kinds():
+    import shutil
+    import tempfile
+    from nose.tools import assert_raises
+    bam = os.path.join(HERE, "small.bam")
+    # CC is only on the first read: later batches are still string columns,
+    # as is a first batch without it.
+    cols = [c["CC"] for c in Bam(bam, tags=["CC", "NH"]).batches(n=1)]
+    assert cols[0] == ["chrX"]
+    assert all(c == [None] for c in cols[1:]), cols[:3]
+    b = Bam(bam, tags=["CC", "NH"])
+    next(b)
+    cols = b.read_batch(3, fields=("pos",))
+    assert cols["CC"] == [None] * 3
+    assert list(cols["NH"]) == [float(a.get_tag("NH")) for a in list(Bam(bam))[1:4]]
+
+    # user tags are numeric unless declared.
+    tmp = tempfile.mkdtemp()
+    sam = os.path.join(tmp, "t.sam")
+    try:
+        with open(AUX_SAM) as fh:
+            lines = fh.read().rstrip("\n").split("\n")
+        lines[-1] += "\tZS:Z:abc"
+        with open(sam, "w") as fh:
+            fh.write("\n".join(lines) + "\n")
+        batches = Bam(sam, tags=["ZS"]).batches(n=1, fields=("pos",))
+        assert all(v != v for v in next(batches)["ZS"])
+        assert_raises(ValueError, next, batches)
+        cols = [c["ZS"] for c in Bam(sam, tags=["ZS:Z"]).batches(n=1, fields=("pos",))]
+        assert cols == [[None], ["abc"]]
+    finally:
+        shutil.rmtree(tmp)
+
+def test_copy_mode_recycles_records():
+    from hts.bam import _bam1_pool
+    bam = os.path.join(HERE, "small.bam")
+    expected = list(map(str, Bam(bam)))
+
+    alns = list(Bam(bam, copy=True))
+    assert list(map(str, alns)) == expected
+    assert list(map(str, Bam(bam, copy=True)("chr2L:1-20000"))) == expected
+
+    n_free = len(_bam1_pool._free)
+    del alns
+    n_free_after = len(_bam1_pool._free)
+    assert n_free_after == n_free + len(expected)
+    copies = list(map(Alignment.copy, Bam(bam)))
+    assert len(_bam1_pool._free) == n_free_after - len(copies)
+
+def _write_pairs_sam(path):
+    # (qname, flag, pos, mate pos): p1 and p3 are pairs, o1's mate is never
+    # seen and o2's mate is before it (skipped).
+    reads = [("p1", 99, 100, 300), ("o1", 97, 150, 200), ("p2", 97, 160, 900),
+             ("p1", 147, 300, 100), ("p3", 99, 400, 450), ("o2", 145, 420, 50),
+             ("p3", 147, 450, 400), ("p2", 145, 900, 160)]
+    with open(path, "w") as fh:
+        fh.write("@HD\tVN:1.0\tSO:coordinate\n@SQ\tSN:chr1\tLN:2000\n")
+        for qname, flag, pos, mpos in reads:
+            fh.write("\t".join(map(str, (qname, flag, "chr1", pos, 60, "10M", "=",
+                                         mpos, 0, "ACGTACGTAC", "IIIIIIIIII"))) + "\n")
+
+def test_pairs():
+    import tempfile
+    sam = tempfile.mktemp(suffix=".sam")
+    _write_pairs_sam(sam)
+    try:
+        bam = Bam(sam)
+        got = [(a.qname, a.pos, b.qname, b.pos) for a, b in bam.pairs()]
+        assert got == [("p1", 99, "p1", 299), ("p3", 399, "p3", 449),
+                       ("p2", 159, "p2", 899)], got
+        assert bam.pair_stats == {"pairs": 3, "orphans": 2, "max_buffered": 3,
+                                  "max_heap": 3}, bam.pair_stats
+
+        bam = Bam(sam)
+        got = [a.qname for a, b in bam.pairs(max_buffer=1)]
+        assert got == ["p3"], got
+        assert bam.pair_stats["max_buffered"] == 1
+    finally:
+        os.unlink(sam)
+
+def test_pairs_heap_bounded():
+    import tempfile
+    sam = tempfile.mktemp(suffix=".sam")
+    n = 5000
+    with open(sam, "w") as fh:
+        fh.write("@SQ\tSN:c1\tLN:100000\n@SQ\tSN:c2\tLN:100000\n")
+        # every mate is on the next contig, so nothing pairs until c2.
+        for i in range(n):
+            fh.write("r%d\t65\tc1\t%d\t60\t10M\tc2\t%d\t0\tAAAAAAAAAA\t*\n" % (i, i + 1, i + 1))
+        for i in range(n):
+            fh.write("r%d\t129\tc2\t%d\t60\t10M\tc1\t%d\t0\tAAAAAAAAAA\t*\n" % (i, i + 1, i + 1))
+    try:
+        bam = Bam(sam)
+        pairs = sum(1 for _ in bam.pairs(max_buffer=100))
+        st = bam.pair_stats
+        assert st["max_buffered"] == 100, st
+        assert st["max_heap"] <= 2 * 100 + 1, st
+        assert pairs == 100 and st["orphans"] == 2 * n - 200, (pairs, st)
+    finally:
+        os.unlink(sam)
+
+def test_multibam_merge():
+    import tempfile
+    from hts import MultiBam
+    from nose.tools import assert_raises
+    src = os.path.join(HERE, "small.bam")
+    alns = list(Bam(src, copy=True))
+    paths = [tempfile.mktemp(suffix=".bam") for _ in range(3)]
+    try:
+        for k, path in enumerate(paths):
+            out = Bam(path, "wb", header=Bam(src).header)
+            out.write(*alns[k::3])
+            out.close()
+
+        merged = [(i, str(a)) for i, a in MultiBam(paths, threads=ThreadPool(2))]
+        assert [s for _, s in merged] == list(map(str, alns))
+        assert [i for i, _ in merged] == [k % 3 for k in range(len(alns))]
+
+        assert_raises(ValueError, MultiBam, [src, AUX_SAM])
+    finally:
+        for path in paths:
+            for f in (path, path + ".bai"):
+                if os.path.exists(f):
+                    os.unlink(f)
+
+def test_cram_reference():
+    import tempfile
+    from hts import Fai
+    from hts.bam import SAM_FLAG, SAM_POS
+    fa = os.path.join(HERE, "t.fa")
+    seq = Fai(fa)("chr1:1-46")
+    tmp = tempfile.mkdtemp()
+    sam, cram = os.path.join(tmp, "r.sam"), os.path.join(tmp, "r.cram")
+    with open(sam, "w") as fh:
+        fh.write(Bam.header_from_fasta(fa))
+        for i, pos in enumerate((1, 5, 11)):
+            s = seq[pos - 1:pos + 19]
+            fh.write("r%d\t0\tchr1\t%d\t60\t20M\t*\t0\t0\t%s\t%s\n" % (i, pos, s, "I" * 20))
+    try:
+        out = Bam(cram, "wc", header=Bam(sam).header, reference=fa)
+        out.write_many(list(Bam(sam, copy=True)))
+        out.close()
+
+        b = Bam(cram, reference=Fai(fa))
+        assert b.reference.fn == fa
+        assert [(a.qname, a.pos, a.seq) for a in b] == \
+               [(a.qname, a.pos, a.seq) for a in Bam(sam)]
+
+        b = Bam(cram, reference=fa, cram_opts={"required_fields": SAM_FLAG | SAM_POS})
+        assert [a.pos for a in b] == [0, 4, 10]
+    finally:
+        for f in os.listdir(tmp):
+            os.unlink(os.path.join(tmp, f))
+        os.rmdir(tmp)
+
+def test_skim_batches():
+    bam = os.path.join(HERE, "small.bam")
+    fields = tuple(Bam.batch_fields)
+    full = list(Bam(bam).batches(n=7, fields=fields))
+    b = Bam(bam, fields={"flag", "pos", "mapq"})
+    assert b._skim
+    skim = list(b.batches(n=7, fields=fields))
+    assert len(skim) == len(full)
+    for s, f in zip(skim, full):
+        assert s == f, (s, f)
+
+    # tags need the full record.
+    assert not Bam(bam, fields={"pos"}, tags=["NH"])._skim
+
+def test_flagstat():
+    fs = Bam(AUX_SAM).flagstat()
+    alns = list(Bam(AUX_SAM, copy=True))
+    primary = [a for a in alns if not a.flag & 0x900]
+    assert fs['total'] == (len(alns), 0)
+    assert fs['paired'][0] == sum(1 for a in primary if a.flag & 1)
+    assert fs['proper_pair'][0] == sum(1 for a in primary if a.flag & 2 and not a.flag & 4)
+    assert fs['read1'][0] + fs['read2'][0] == fs['paired'][0]
+    assert list(fs) == list(Bam.flagstat_keys)
+
+def test_async_bam_interleaved():
+    from hts.aio import AsyncBam
+    bam = os.path.join(HERE, "small.bam")
+    region = 'chr2L:1-23011544'
+    expected = [str(a) for a in Bam(bam)(region)]
+    ab = AsyncBam(bam, max_workers=1, batch_size=2)
+    try:
+        # both queries share the one handle; each batch re-seeks.
+        q1, q2 = ab.query(region), ab.query(region)
+        got1, got2 = [], []
+        for a, b in zip(q1, q2):
+            got1.append(str(a))
+            got2.append(str(b))
+        got1.extend(map(str, q1))
+        got2.extend(map(str, q2))
+        assert got1 == expected and got2 == expected
+    finally:
+        ab.close()
+
+def test_async_bam_threads():
+    import threading
+    from hts.aio import AsyncBam
+    from nose.tools import assert_raises
+    bam = os.path.join(HERE, "small.bam")
+    region = 'chr2L:1-23011544'
+    expected = [str(a) for a in Bam(bam)(region)]
+    ab = AsyncBam(bam, max_workers=2, batch_size=3)
+    results = {}
+    def run(k):
+        results[k] = list(map(str, ab.fetch(region)))
+    # many short-lived threads share the fixed pool of handles.
+    threads = [threading.Thread(target=run, args=(k,)) for k in range(50)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert len(results) == 50 and all(r == expected for r in results.values())
+    assert len(ab._all) == 2 and ab._handles.qsize() == 2
+
+    ab.close()
+    assert ab._handles.qsize() == 0
+    assert_raises(ValueError, ab.fetch, region)
+
+def test_cache_estimate_blocks():
+    from hts.htsffi import ffi
+    bam = os.path.join(HERE, "small.bam")
+    regions = ['chr2L:9000-11000', 'chr2L:1-23011544', 'chr2L:9000-9500']
+    counts = []
+    for n in (64, 1):
+        b = Bam(bam, cache_size=1 << 20)
+        # a buffer too small for the blocks of a query is grown, not truncated.
+        b.cache_estimate._buf = ffi.new("int64_t[]", n)
+        for r in regions:
+            list(b(r))
+        counts.append((b.cache_estimate.hits, b.cache_estimate.misses))
+    assert counts[0] == counts[1], counts
+    assert counts[0][1] >= 2, counts
+
+def test_bam_index_cache():
+    import shutil
+    import tempfile
+    from hts import BamIndex
+    from nose.tools import assert_raises
+    tmp = tempfile.mkdtemp()
+    fn = os.path.join(tmp, "small.bam")
+    try:
+        shutil.copy(os.path.join(HERE, "small.bam"), fn)
+        shutil.copy(os.path.join(HERE, "small.bam.bai"), fn + ".bai")
+        idx = BamIndex.cached(fn)
+        assert BamIndex.cached(fn) is idx
+        b = Bam(fn, index=True)
+        assert b._index is idx
+        assert len(list(b('chr2L:9000-11000'))) == 10
+
+        # a modified file gets a new index.
+        st = os.stat(fn)
+        for f in (fn, fn + ".bai"):
+            os.utime(f, (st.st_atime, st.st_mtime + 10))
+        idx = BamIndex.cached(fn)
+        assert idx is not None and BamIndex.cached(fn) is idx
+
+        # so does a modified index alone.
+        os.utime(fn + ".bai", (st.st_atime, st.st_mtime + 20))
+        assert BamIndex.cached(fn) is not idx
+
+        # a deleted index is not served from the cache; it is created
+        # again unless create_index is False.
+        idx = BamIndex.cached(fn)
+        os.unlink(fn + ".bai")
+        assert_raises(Exception, Bam, fn, index=True, create_index=False)
+        b = Bam(fn, index=True)
+        assert os.path.exists(fn + ".bai")
+        assert b._index is not idx and b._index is BamIndex.cached(fn)
+        assert len(list(b('chr2L:9000-11000'))) == 10
+
+        # create_index=True rebuilds the index and replaces the cached one.
+        idx = b._index
+        b = Bam(fn, index=True, create_index=True)
+        assert b._index is not idx
+        assert len(list(b('chr2L:9000-11000'))) == 10
+        BamIndex.clear_cache()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_coverage_colon_names():
+    import shutil
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    sam, bam = os.path.join(tmp, "r.sam"), os.path.join(tmp, "r.bam")
+    chroms = ["HLA-A*01:01:01:01", "chr1"]
+    try:
+        with open(sam, "w") as fh:
+            for c in chroms:
+                fh.write("@SQ\tSN:%s\tLN:3000\n" % c)
+            for i, pos in enumerate(range(1, 2950, 10)):
+                fh.write("r%d\t0\t%s\t%d\t60\t50M\t*\t0\t0\t%s\t%s\n"
+                         % (i, chroms[0], pos, "A" * 50, "I" * 50))
+        out = Bam(bam, "wb", header=Bam(sam).header)
+        out.write_many(list(Bam(sam, copy=True)))
+        out.close()
+
+        b = Bam(bam)
+        cov = b.coverage(chroms[0])
+        assert len(cov) == 3000 and list(cov[:12]) == [1] * 10 + [2] * 2
+        assert sum(cov) == 295 * 50
+        assert sum(b.coverage("chr1")) == 0
+        d = b.pileup(chroms[0], depth=True, overlap_adjust=False)
+        assert list(d) == list(cov)
+        d = b.pileup(chroms[0] + ":1-12", depth=True, overlap_adjust=False)
+        assert list(d) == list(cov[:12])
+    finally:
+        shutil.rmtree(tmp)
+
+def test_flagstat_cram_region():
+    import random
+    import shutil
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    fa, sam, cram = [os.path.join(tmp, f) for f in ("r.fa", "r.sam", "r.cram")]
+    random.seed(1)
+    seqs = dict((c, "".join(random.choice("ACGT") for _ in range(3000))) for c in ("c1", "c2"))
+    try:
+        with open(fa, "w") as fh:
+            for c in ("c1", "c2"):
+                fh.write(">%s\n%s\n" % (c, seqs[c]))
+        with open(sam, "w") as fh:
+            fh.write(Bam.header_from_fasta(fa))
+            i = 0
+            for c in ("c1", "c2"):
+                for pos in range(1, 2950, 10):
+                    fh.write("r%d\t0\t%s\t%d\t60\t50M\t*\t0\t0\t%s\t%s\n"
+                             % (i, c, pos, seqs[c][pos - 1:pos + 49], "I" * 50))
+                    i += 1
+        out = Bam(cram, "wc", header=Bam(sam).header, reference=fa)
+        out.write_many(list(Bam(sam, copy=True)))
+        out.close()
+
+        b = Bam(cram, reference=fa)
+        region = 'c2:1000-1100'
+        fs = b.flagstat(region)
+        # the handle of b is not moved by flagstat.
+        assert len(list(b)) == i
+        n = len(list(b(region)))
+        assert 0 < n < i
+        assert fs['total'] == (n, 0)
+    finally:
+        shutil.rmtree(tmp)
@@ -16,3 +16,83 @@ def test_build():
 def test_error_on_bad_file():
     assert_raises(Exception, Tbx, BAM)
 
+
+def test_query_columns():
+    t = Tbx(GTF)
+    region = 'chr1:1-50000'
+    rows = list(t(region))
+    assert len(rows) > 0
+    chroms, starts, ends, scores, attrs = t.query_columns(region, [0, 3, 4, 5, 8],
+                                                          ['s', 'i', 'l', 'd', 's'])
+    assert chroms == [r[0] for r in rows]
+    assert list(starts) == [r[3] for r in rows]
+    assert list(ends) == [r[4] for r in rows]
+    assert attrs == [r[8] for r in rows]
+    # small batches give the same result.
+    assert t.query_columns(region, batch_size=3)[1] == starts
+
+    # columns past the end of a line are empty.
+    assert t.query_columns(region, [20], ['s'])[0] == [''] * len(rows)
+
+    res = list(t.query_many([region, 'chrX:1-10', region], columns=[3], dtypes=['i']))
+    assert [r for r, _ in res] == [region, 'chrX:1-10', region]
+    assert [len(c[0]) for _, c in res] == [len(rows), 0, len(rows)]
+
+def test_intervals_overlaps():
+    import random
+    t = Tbx(GTF)
+    iv = t.load_intervals()
+    assert iv.chroms == t.sequences
+    rows = [r for c in t.sequences for r in t(str(c))]
+    assert len(iv) == len(rows)
+    assert all(iv.starts[i] == r[3] - 1 and iv.ends[i] == r[4] for i, r in enumerate(rows))
+
+    random.seed(42)
+    for chrom in iv.chroms:
+        qs = [random.randint(0, 60000) for _ in range(300)]
+        qe = [s + random.randint(1, 3000) for s in qs]
+        q, ids = iv.overlaps(qs, qe, chrom=chrom)
+        found = sorted(zip(q, ids))
+        expected = sorted((j, i) for j in range(len(qs)) for i, r in enumerate(rows)
+                          if r[0] == chrom and iv.starts[i] < qe[j] and qs[j] < iv.ends[i])
+        assert found == expected, (chrom, len(found), len(expected))
+
+    assert len(iv.overlaps([0], [10], chrom="chrX")[0]) == 0
+    assert_raises(AssertionError, iv.overlaps, [0], [10])
+
+def test_intervals_bed():
+    import shutil
+    import tempfile
+    from hts.tbx import TBX_UCSC
+    bed = os.path.join(tempfile.mkdtemp(), "example.bed.gz")
+    shutil.copy(os.path.join(HERE, "example.bed.gz"), bed)
+    rows = [r for c in Tbx(GTF).sequences for r in Tbx(GTF)(str(c))]
+
+    t = Tbx(bed)
+    assert t._tbx.conf.preset & TBX_UCSC
+    iv = t.load_intervals(columns=[3], dtypes=['s'])
+    assert sorted(zip(iv.starts, iv.ends, iv.columns[0])) == \
+            sorted((r[3] - 1, r[4], r[2]) for r in rows)
+    # intervals ending at 2090 do not overlap [2090, 2091).
+    _, ids = iv.overlaps([2090], [2091], chrom='chr1')
+    assert len(ids) == len([r for r in rows if r[0] == 'chr1' and r[3] - 1 < 2091 and r[4] > 2090])
+    assert all(iv.ends[i] > 2090 for i in ids)
+
+    # an index built without the UCSC flag is still read as BED.
+    os.unlink(bed + ".tbi")
+    Tbx.build(bed)
+    t = Tbx(bed)
+    assert not t._tbx.conf.preset & TBX_UCSC
+    assert list(t.load_intervals().starts) == list(iv.starts)
+    shutil.rmtree(os.path.dirname(bed))
+
+def test_cache_estimate():
+    t = Tbx(GTF, cache_size=4 << 20)
+    for region in ('chr1:1-50000', 'chr1:1-1800', 'chr1:1-50000'):
+        list(t(region))
+    st = t.cache_estimate
+    assert st.misses > 0 and st.hits > 0, st
+    assert 0 < st.hit_rate < 1
+    st.reset()
+    assert (st.hits, st.misses) == (0, 0)
+    assert Tbx(GTF).cache_estimate is None
@@ -0,0 +1,112 @@
+import os
+from hts import VCF
+
+HERE = os.path.dirname(__file__)
+VCF_PATH = os.path.join(HERE, "test.query.vcf")
+
+def test_genotype_matrix():
+    expected = [v.genotypes for v in VCF(VCF_PATH)]
+
+    vcf = VCF(VCF_PATH)
+    n = vcf.n_samples
+    rows = []
+    for chunk in vcf.genotype_matrix(chunk=300):
+        gts = chunk["gt_types"]
+        assert len(gts) == n * len(chunk["pos"])
+        rows.extend(list(gts[i * n:(i + 1) * n]) for i in range(len(chunk["pos"])))
+
+    assert len(rows) == len(expected)
+    for row, exp in zip(rows, expected):
+        if exp[0] is not None:
+            assert row == exp
+
+def test_region_query_builds_index():
+    import shutil
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    gz = os.path.join(tmp, "test.query.vcf.gz")
+    try:
+        shutil.copy(os.path.join(HERE, "test.query.vcf.gz"), gz)
+        vcf = VCF(gz)
+        assert not os.path.exists(gz + ".tbi")
+
+        got = [v.pos for v in vcf("chr1:860000-870000")]
+        assert os.path.exists(gz + ".tbi")
+        exp = [v.pos for v in VCF(VCF_PATH) if 860000 <= v.pos + 1 <= 870000]
+        assert got == exp and len(got) > 0, (got, exp)
+        assert list(vcf("chr2:1-1000")) == []
+    finally:
+        shutil.rmtree(tmp)
+
+def test_plain_gzip_reads_without_index():
+    import gzip
+    import shutil
+    import tempfile
+    from nose.tools import assert_raises
+    tmp = tempfile.mkdtemp()
+    gz = os.path.join(tmp, "plain.vcf.gz")
+    try:
+        with open(VCF_PATH, "rb") as fin:
+            fout = gzip.open(gz, "wb")
+            fout.write(fin.read())
+            fout.close()
+        vcf = VCF(gz)
+        assert [v.pos for v in vcf] == [v.pos for v in VCF(VCF_PATH)]
+        # not bgzipped, so it can not be indexed for region queries.
+        assert_raises(Exception, list, vcf("chr1:860000-870000"))
+        assert os.listdir(tmp) == ["plain.vcf.gz"]
+    finally:
+        shutil.rmtree(tmp)
+
+def test_lazy_unpack():
+    eager = [(v.pos, v.ref, v.alt, v.genotypes) for v in VCF(VCF_PATH)]
+    lazy = [(v.pos, v.ref, v.alt, v.genotypes) for v in VCF(VCF_PATH, lazy=True)]
+    assert eager == lazy
+
+    v = next(VCF(VCF_PATH, lazy=True))
+    assert v._bcf.unpacked == 0
+    v.ref
+    assert v._bcf.unpacked & 8 == 0
+
+def test_samples_subset():
+    from nose.tools import assert_raises
+    full = VCF(VCF_PATH)
+    names = full.samples[5:8]
+    idx = [full.samples.index(n) for n in names]
+    expected = [[v.genotypes[i] for i in idx] for v in full]
+
+    for path in (VCF_PATH, os.path.join(HERE, "test.query.vcf.gz")):
+        vcf = VCF(path, samples=names)
+        assert vcf.n_samples == 3 and vcf.samples == names
+        assert [v.genotypes for v in vcf] == expected
+
+    sites = VCF(VCF_PATH, samples=[])
+    assert sites.n_samples == 0
+    assert next(sites).genotypes == []
+
+    assert_raises(KeyError, VCF, VCF_PATH, samples=["not-a-sample"])
+
+    excluded = VCF(VCF_PATH, samples=["^" + n for n in names])
+    assert excluded.samples == [n for n in full.samples if n not in names]
+    assert_raises(ValueError, VCF, VCF_PATH, samples=["^" + names[0], names[1]])
+
+def test_write_roundtrip():
+    import tempfile
+    src = VCF(VCF_PATH, samples=["1094PC0005", "1094PC0018"])
+    keep = [v for v in src if v.pos % 2 == 0]
+
+    for mode, suffix in (("wz", ".vcf.gz"), ("wb", ".bcf")):
+        tmp = tempfile.mktemp(suffix=suffix)
+        out = VCF(tmp, mode, header=src, threads=2, create_index=True)
+        out.write(*keep)
+        out.close()
+
+        back = VCF(tmp)
+        assert back.samples == src.samples
+        assert [(v.pos, v.ref, v.alt, v.genotypes) for v in back] == \
+               [(v.pos, v.ref, v.alt, v.genotypes) for v in keep]
+        assert len(list(back("chr1:860000-870000"))) > 0
+
+        for f in (tmp, tmp + ".tbi", tmp + ".csi"):
+            if os.path.exists(f):
+                os.unlink(f)
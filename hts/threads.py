@@ -0,0 +1,58 @@
+from .htsffi import libhts, ffi, _raise_if_null
+import atexit
+
+
+class ThreadPool(object):
+
+    """
+    A pool of htslib worker threads for (de)compression.
+
+    A single pool can be shared by several `Bam`, `VCF` and `Tbx` handles
+    via their `threads` argument so the total thread count stays bounded.
+
+    Parameters
+    ----------
+
+    n : int
+        number of worker threads.
+
+    Examples
+    --------
+
+    >>> import os.path as op
+    >>> from hts import Bam
+    >>> pool = ThreadPool(2)
+    >>> pool
+    ThreadPool(2)
+    >>> bam = Bam("%s/test/small.bam" % op.dirname(__file__), threads=pool)
+    >>> next(bam)
+    Alignment('HWUSI-NAME:2:69:512:1017#0')
+    """
+
+    def __init__(self, n):
+        self.n = n
+        p = self._p = ffi.new("htsThreadPool *")
+        p.pool = libhts.hts_tpool_init(n)
+        _raise_if_null(p.pool, "ThreadPool: unable to start %d threads" % n)
+        p.qsize = 0
+        atexit.register(libhts.hts_tpool_destroy, p.pool)
+
+    def __repr__(self):
+        return "%s(%d)" % (self.__class__.__name__, self.n)
+
+
+def set_threads(htf, threads):
+    """Attach `threads` (an int or a `ThreadPool`) to an open htsFile.
+
+    An int creates threads owned by the file itself. Returns the
+    `ThreadPool` (or None) so callers can keep it alive as long as the file.
+    """
+    if not threads:
+        return None
+    if isinstance(threads, ThreadPool):
+        if libhts.hts_set_thread_pool(htf, threads._p) != 0:
+            raise Exception("unable to attach thread pool")
+        return threads
+    if libhts.hts_set_threads(htf, int(threads)) != 0:
+        raise Exception("unable to set %d threads" % threads)
+    return None
@@ -1,7 +1,13 @@
 from __future__ import print_function
+import array
 import os
 import sys
 from .htsffi import libhts, ffi, _raise_if_null
+from .threads import set_threads
+from .cache import set_cache
+
+# tbx_conf_t.preset for VCF in htslib/tbx.h
+TBX_VCF = 2
 
 
 class VCF(object):
@@ -19,15 +25,208 @@ class VCF(object):
     >>> v.genotypes[:10]
     [2, 2, 2, 2, 2, 2, 0, 2, 2, 2]
 
+    >>> v.ref, v.alt, v.id
+    ('T', ['G'], '.')
+
+    Decode only some samples.
+
+    >>> vcf = VCF('%s/test/test.query.vcf' % op.dirname(__file__),
+    ...           samples=['1094PC0018', '1094PC0005'])
+    >>> vcf.n_samples, vcf.samples
+    (2, ['1094PC0005', '1094PC0018'])
+    >>> next(vcf).genotypes
+    [2, 0]
+
+    With lazy=True, only the parts of each record that are used are decoded,
+    so e.g. sites-only scans skip decoding the samples.
+
+    >>> vcf = VCF('%s/test/test.query.vcf' % op.dirname(__file__), lazy=True)
+    >>> [v.pos for v in vcf][:3]
+    [30547, 30859, 30866]
+
+    Indexed (BCF or bgzipped VCF) files support region queries.
+
+    >>> vcf = VCF('%s/test/test.query.vcf.gz' % op.dirname(__file__))
+    >>> list(vcf('chr1:30500-30900'))
+    [Variant('chr1:30547'), Variant('chr1:30859'), Variant('chr1:30866'), Variant('chr1:30894')]
+
     """
 
-    def __init__(self, fname, mode="r"):
+    def __init__(self, fname, mode="r", threads=None, create_index="auto", lazy=False,
+                 samples=None, samples_file=None, header=None, cache_size=None):
+        self.fname, self.mode, self.lazy = fname, mode, lazy
+        self._idx = self._tbx = ffi.NULL
+        self.cache_estimate = None
+        if mode[0] == "w":
+            self._init_writer(header, threads, create_index)
+            return
+
         if not os.path.exists(fname):
             raise Exception("%s not found" % fname)
         htf = self._htf = libhts.hts_open(fname, mode)
+        self._pool = set_threads(htf, threads)
+        self.cache_estimate = set_cache(htf, cache_size)
         hdr = self._hdr = libhts.bcf_hdr_read(htf)
-        assert libhts.bcf_hdr_set_samples(hdr, "-", 0) == 0, ("error setting samples")
-        self.fname = fname
+        self._set_samples(samples, samples_file)
+        # the index is loaded (or built) by the first region query so that
+        # reading files that can not be indexed does not depend on it.
+        self._create_index, self._index_loaded = create_index, False
+        if create_index is True:
+            self._load_index()
+
+    def _init_writer(self, header, threads, create_index):
+        assert hasattr(header, "_hdr"), ("VCF: header=VCF required to write", self.fname)
+        htf = self._htf = libhts.hts_open(self.fname, self.mode)
+        _raise_if_null(htf, "VCF: unable to open %s" % self.fname)
+        self._pool = set_threads(htf, threads)
+        self._hdr = libhts.bcf_hdr_dup(header._hdr)
+        self._index_on_close = create_index is True
+        if libhts.bcf_hdr_write(htf, self._hdr) != 0:
+            raise Exception("VCF: error writing header to %s" % self.fname)
+
+    def write(self, *variants):
+        """
+        Write variants to the current file.
+
+        The file must have been opened with mode "w" (VCF), "wz" (bgzipped
+        VCF) or "wb" (BCF) and the header of the `VCF` the variants came from.
+        With create_index=True the file is indexed when it is closed.
+
+        >>> import os.path as op
+        >>> src = VCF('%s/test/test.query.vcf' % op.dirname(__file__))
+        >>> out = VCF('out.bcf', 'wb', header=src, create_index=True)
+        >>> out.write(*[v for v in src if v.pos < 70000])
+        >>> out.close()
+        >>> list(VCF('out.bcf')('chr1:69400-69600'))
+        [Variant('chr1:69427'), Variant('chr1:69510')]
+        """
+        for v in variants:
+            if libhts.bcf_write(self._htf, self._hdr, v._bcf) != 0:
+                raise Exception("VCF: error writing %r to %s" % (v, self.fname))
+
+    def close(self):
+        """Close the current file."""
+        if libhts.hts_close(self._htf) != 0:
+            raise Exception("VCF: error closing %s" % self.fname)
+        if self.mode[0] == "w" and self._index_on_close:
+            if not self._build_index("b" in self.mode):
+                raise Exception("VCF: unable to index %s" % self.fname)
+
+    def _set_samples(self, samples, samples_file):
+        """Restrict decoding to a subset of samples.
+
+        htslib then skips the FORMAT data of the other samples when reading so
+        the cost scales with the number of selected samples. If every name
+        is prefixed by "^" (e.g. ["^NA12878", "^NA12891"]), those samples are
+        excluded instead. An empty list gives sites-only records.
+        """
+        if samples_file is not None:
+            ret = libhts.bcf_hdr_set_samples(self._hdr, samples_file, 1)
+        elif samples is None:
+            ret = libhts.bcf_hdr_set_samples(self._hdr, "-", 0)
+        elif len(samples) == 0:
+            ret = libhts.bcf_hdr_set_samples(self._hdr, ffi.NULL, 0)
+        else:
+            # htslib takes a single "^" before the list to exclude samples.
+            exclude = [n.startswith("^") for n in samples]
+            if any(exclude) and not all(exclude):
+                raise ValueError("VCF: can not both include and exclude samples: %s" % samples)
+            names = ",".join(n[1:] if exclude[0] else n for n in samples)
+            ret = libhts.bcf_hdr_set_samples(self._hdr, ("^" if exclude[0] else "") + names, 0)
+
+        if ret < 0:
+            raise Exception("VCF: error setting samples for %s" % self.fname)
+        if ret > 0:
+            name = samples_file if samples_file is not None else samples[ret - 1]
+            raise KeyError("VCF: sample not in %s: %s (#%d)" % (self.fname, name, ret))
+
+    @property
+    def samples(self):
+        """List of the (selected) sample names."""
+        return [ffi.string(self._hdr.samples[i]) for i in range(self.n_samples)]
+
+    def _build_index(self, is_bcf):
+        """Write a CSI index for BCF or a tabix index for bgzipped VCF.
+        Returns False if the file could not be indexed."""
+        fname = self.fname
+        if is_bcf:
+            return libhts.bcf_index_build(fname, 14) == 0
+        conf = ffi.new('tbx_conf_t *')
+        conf.preset, conf.sc, conf.bc, conf.ec = TBX_VCF, 1, 2, 0
+        conf.meta_char, conf.line_skip = ord('#'), 0
+        return libhts.tbx_index_build(fname, 0, conf) == 0
+
+    def _load_index(self):
+        """Load the index, building it as per create_index. If that fails,
+        e.g. for plain gzip or a read-only directory, the file can only be
+        read sequentially."""
+        fname, create_index = self.fname, self._create_index
+        self._index_loaded = True
+        if not fname.endswith((".bcf", ".gz")):
+            return
+        if fname.endswith(".bcf"):
+            idx = libhts.bcf_index_load(fname)
+            if (idx == ffi.NULL and create_index == "auto") or create_index is True:
+                if self._build_index(True):
+                    idx = libhts.bcf_index_load(fname)
+            self._idx = idx
+            return
+
+        if ((not os.path.exists("%s.tbi" % fname) and not os.path.exists("%s.csi" % fname)
+                and create_index == "auto") or create_index is True):
+            if not self._build_index(False):
+                return
+        self._tbx = libhts.tbx_index_load(fname)
+
+    def _reader(self, region=None):
+        """A vcf_reader_t over the whole file or a region; free with _free_reader."""
+        reader = ffi.new("vcf_reader_t *")
+        reader.fp, reader.h = self._htf, self._hdr
+        reader.itr = reader.tbx = ffi.NULL
+        if region is None:
+            return reader
+
+        if not self._index_loaded:
+            self._load_index()
+        if self._idx != ffi.NULL:
+            reader.itr = libhts.bcf_itr_querys(self._idx, self._hdr, region)
+        elif self._tbx != ffi.NULL:
+            reader.itr = libhts.tbx_itr_querys(self._tbx, region)
+            reader.tbx = self._tbx
+        else:
+            raise Exception("VCF: %s is not indexed and could not be; region queries "
+                            "need a bgzipped VCF or BCF" % self.fname)
+        if self.cache_estimate is not None:
+            self.cache_estimate.record(reader.itr)
+        return reader
+
+    def _free_reader(self, reader):
+        if reader.itr != ffi.NULL:
+            libhts.hts_itr_destroy(reader.itr)
+        libhts.free(reader.s.s)
+
+    def __call__(self, region):
+        """Generate the variants overlapping a region.
+
+        Parameters
+        ----------
+        region : str
+            region to query, e.g. chr1:1234-5678
+        """
+        reader = self._reader(region)
+        # an unknown sequence gives no iterator, i.e. no variants.
+        if reader.itr == ffi.NULL:
+            return
+        try:
+            while True:
+                bcf_t = ffi.gc(libhts.bcf_init(), libhts.bcf_destroy)
+                if libhts.vcf_next(reader, bcf_t) < 0:
+                    break
+                yield Variant(bcf_t, self)
+        finally:
+            self._free_reader(reader)
+
+    query = __call__
 
     def __repr__(self):
         return "%s('%s')" % (self.__class__.__name__, self.fname)
@@ -36,7 +235,7 @@ class VCF(object):
         return self
 
     def __next__(self):
-        bcf_t = libhts.bcf_init()
+        bcf_t = ffi.gc(libhts.bcf_init(), libhts.bcf_destroy)
         if libhts.bcf_read(self._htf, self._hdr, bcf_t) >= 0:
             return Variant(bcf_t, self)
         raise StopIteration
@@ -51,12 +250,102 @@ class VCF(object):
     def n_samples(self):
         return self._hdr.n[libhts.BCF_DT_SAMPLE]
 
+    def genotype_matrix(self, region=None, chunk=10000, depths=False, quals=False):
+        """Generate genotypes of up to `chunk` variants at a time as columns.
+
+        Genotypes are extracted in C into preallocated arrays so memory is
+        bounded by `chunk` * `n_samples` regardless of the size of the file.
+
+        Parameters
+        ----------
+        region : str, optional
+            region to query, e.g. chr1:1234-5678. If None, the remainder of
+            the file is read.
+
+        chunk : int
+            maximum number of variants per yielded chunk.
+
+        depths : bool
+            include the per-sample depth (DP) as "gt_depths".
+
+        quals : bool
+            include the per-sample genotype quality (GQ) as "gt_quals".
+
+        Returns
+        -------
+        generator of dicts with "chrom" and "pos" (one value per variant) and
+        "gt_types" (array('b') with the codes of `Variant.gt_types`), and
+        optionally "gt_depths" (array('i')) and "gt_quals" (array('f')),
+        each stored row-major (variants x samples), so e.g.
+        numpy.frombuffer(d["gt_types"], dtype=numpy.int8).reshape(-1, vcf.n_samples).
+        Missing depths and qualities are -1.
+
+        >>> import os.path as op
+        >>> vcf = VCF('%s/test/test.query.vcf' % op.dirname(__file__))
+        >>> m = next(vcf.genotype_matrix(chunk=100, depths=True, quals=True))
+        >>> len(m['pos']), len(m['gt_types']) == 100 * vcf.n_samples
+        (100, True)
+        >>> m['chrom'][0], m['pos'][0]
+        ('chr1', 30547)
+        >>> list(m['gt_types'][:10])
+        [2, 2, 2, 2, 2, 2, 0, 2, 2, 2]
+        >>> list(m['gt_depths'][:10])
+        [-1, -1, -1, -1, -1, -1, 1, -1, -1, -1]
+
+        >>> vcf = VCF('%s/test/test.query.vcf.gz' % op.dirname(__file__))
+        >>> list(next(vcf.genotype_matrix('chr1:30500-30900'))['pos'])
+        [30547, 30859, 30866, 30894]
+        """
+        reader = self._reader(region)
+        if reader.itr == ffi.NULL and region is not None:
+            return
+        b = libhts.bcf_init()
+        n_samples = self.n_samples
+        try:
+            while True:
+                rid, pos = array.array('i', [0]) * chunk, array.array('i', [0]) * chunk
+                res = {"pos": pos,
+                       "gt_types": array.array('b', [0]) * (chunk * n_samples)}
+                ptrs = [ffi.cast("int32_t *", ffi.from_buffer(rid)),
+                        ffi.cast("int32_t *", ffi.from_buffer(pos)),
+                        ffi.cast("int8_t *", ffi.from_buffer(res["gt_types"])),
+                        ffi.NULL, ffi.NULL]
+                if depths:
+                    res["gt_depths"] = array.array('i', [0]) * (chunk * n_samples)
+                    ptrs[3] = ffi.cast("int32_t *", ffi.from_buffer(res["gt_depths"]))
+                if quals:
+                    res["gt_quals"] = array.array('f', [0]) * (chunk * n_samples)
+                    ptrs[4] = ffi.cast("float *", ffi.from_buffer(res["gt_quals"]))
+
+                n = libhts.vcf_read_genotypes(reader, b, chunk, n_samples, *ptrs)
+                del ptrs
+                if n < -1:
+                    raise Exception("VCF: error reading %s" % self.fname)
+                if n == 0:
+                    break
+
+                if n < chunk:
+                    for k in res:
+                        del res[k][(n * n_samples if k.startswith("gt_") else n):]
+                res["chrom"] = [self.seq(r) for r in rid[:n]]
+                yield res
+                if n < chunk:
+                    break
+        finally:
+            libhts.bcf_destroy(b)
+            self._free_reader(reader)
+
 class Variant(object):
-    """Variants are created from VCF"""
+    """Variants are created from VCF
+
+    If the `VCF` was opened with lazy=True, each part of the record (ID/REF/ALT,
+    FILTER, INFO, FORMAT) is only decoded when it is first needed.
+    """
 
     def __init__(self, bcf_t, vcf):
         self._bcf = bcf_t
-        libhts.bcf_unpack(bcf_t, 15)  # unpack everything.
+        if not vcf.lazy:
+            libhts.bcf_unpack(bcf_t, libhts.BCF_UN_ALL)  # unpack everything.
 
         self.vcf = vcf
         self.chrom = vcf.seq(bcf_t.rid)
@@ -65,12 +354,42 @@ class Variant(object):
     def __repr__(self):
         return "%s('%s:%d')" % (self.__class__.__name__, self.chrom, self.pos)
 
+    def _unpack(self, which):
+        if self._bcf.unpacked & which != which:
+            libhts.bcf_unpack(self._bcf, which)
+
+    @property
+    def id(self):
+        """ID of the variant."""
+        self._unpack(libhts.BCF_UN_STR)
+        return ffi.string(self._bcf.d.id)
+
+    @property
+    def ref(self):
+        """Reference allele."""
+        self._unpack(libhts.BCF_UN_STR)
+        return ffi.string(self._bcf.d.allele[0])
+
+    @property
+    def alt(self):
+        """List of alternate alleles."""
+        self._unpack(libhts.BCF_UN_STR)
+        return [ffi.string(self._bcf.d.allele[i]) for i in range(1, self._bcf.n_allele)]
+
+    @property
+    def qual(self):
+        """Variant quality."""
+        return self._bcf.qual
+
     @property
     def formats(self):
+        self._unpack(libhts.BCF_UN_FMT)
         return Format(self._bcf.d.fmt)
 
     @property
     def genotypes(self):
+        if self.vcf.n_samples == 0:
+            return []
 
         dst = ffi.new("int **")
         ndst = ffi.new("int *")